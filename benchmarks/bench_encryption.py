@@ -0,0 +1,316 @@
+"""
+Offline microbenchmarks for the encryption.py primitives, the handshake and the transport path.
+
+Everything runs against fixed test keys (no network, no server), so numbers are comparable between runs.
+
+    python benchmarks/bench_encryption.py                                   # print results
+    python benchmarks/bench_encryption.py --output results.json             # machine-readable results
+    python benchmarks/bench_encryption.py --save-baseline baseline.json     # store a baseline
+    python benchmarks/bench_encryption.py --baseline baseline.json          # compare, exit 1 on regression
+
+Each case reports the median of --repeat timed runs, taken in rounds across all cases. The run-to-run noise of a case
+(median absolute deviation, relative to the median) is recorded too. A case counts as a regression once it is slower
+than the baseline by more than --threshold plus NOISE_FACTOR times the larger of the two noise figures, and the run
+only fails if it still is when those cases are measured again.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import encryption
+
+# Fixed test keys so every run does identical work
+CLIENT_PRIVATE_KEY_STATIC = bytes(range(1, 33))
+SERVER_PRIVATE_KEY_STATIC = bytes(range(33, 65))
+CLIENT_PRIVATE_KEY_EPHEMERAL = bytes(range(65, 97))
+SERVER_PRIVATE_KEY_EPHEMERAL = bytes(range(97, 129))
+FIXED_TIMESTAMP = 1700000000.0
+PAYLOAD_SIZES = (16, 128, 512, 1400)
+PACKET_POOL = 4096
+
+# How many times a case's measured noise is added to the regression threshold
+NOISE_FACTOR = 3
+
+
+def _public(private_key):
+    return encryption.nacl.bindings.crypto_scalarmult_base(private_key)
+
+
+SERVER_PUBLIC_KEY_STATIC = _public(SERVER_PRIVATE_KEY_STATIC)
+CLIENT_PUBLIC_KEY_EPHEMERAL = _public(CLIENT_PRIVATE_KEY_EPHEMERAL)
+SERVER_PUBLIC_KEY_EPHEMERAL = _public(SERVER_PRIVATE_KEY_EPHEMERAL)
+
+
+def _initiation(template=None):
+    return encryption.get_Initiation_Message(
+        SERVER_PUBLIC_KEY_STATIC, CLIENT_PRIVATE_KEY_STATIC,
+        CLIENT_PRIVATE_KEY_EPHEMERAL, CLIENT_PUBLIC_KEY_EPHEMERAL,
+        FIXED_TIMESTAMP, 1, template=template)
+
+
+def _response(init_msg):
+    responder_info = encryption.consume_Initiation_Message(init_msg, SERVER_PRIVATE_KEY_STATIC, SERVER_PUBLIC_KEY_STATIC)
+    return encryption.get_Server_Response(responder_info, SERVER_PRIVATE_KEY_EPHEMERAL, SERVER_PUBLIC_KEY_EPHEMERAL, 2)
+
+
+def _session_pair():
+    handshake_info, init_msg, _ = _initiation()
+    chain_key, server_index, response = _response(init_msg)
+    chain_key, handshake_info = encryption.parse_Server_Response(response, handshake_info, CLIENT_PRIVATE_KEY_STATIC)
+    client = encryption.TransportSession.from_handshake(chain_key, handshake_info)
+    server = encryption.TransportSession.for_responder(chain_key, server_index, handshake_info['client_index'])
+    return handshake_info, chain_key, client, server
+
+
+# Each case takes an op count n, does any setup, and returns a zero-argument callable that performs n ops
+
+def case_hash(n):
+    data = b'\x00' * 64
+    return lambda: [encryption.Hash(data) for _ in range(n)]
+
+
+def case_hmac(n):
+    key, data = b'\x01' * 32, b'\x00' * 32
+    return lambda: [encryption.HMAC(key, data) for _ in range(n)]
+
+
+def case_kdf(kdf):
+    def case(n):
+        key, data = b'\x01' * 32, b'\x00' * 32
+        return lambda: [kdf(key, data) for _ in range(n)]
+    return case
+
+
+def case_timestamp(n):
+    return lambda: [encryption.Timestamp(FIXED_TIMESTAMP) for _ in range(n)]
+
+
+def case_aead_encrypt(size):
+    def case(n):
+        key, nonce, payload = b'\x01' * 32, b'\x00' * 12, b'\x00' * size
+        return lambda: [encryption.AEAD_encrypt(key, nonce, payload, b'') for _ in range(n)]
+    return case
+
+
+def case_aead_decrypt(size):
+    def case(n):
+        key, nonce = b'\x01' * 32, b'\x00' * 12
+        ciphertext = encryption.AEAD_encrypt(key, nonce, b'\x00' * size, b'')
+        return lambda: [encryption.AEAD_decrypt(key, nonce, ciphertext, b'') for _ in range(n)]
+    return case
+
+
+def case_initiation(use_template):
+    def case(n):
+        template = encryption.HandshakeTemplate(SERVER_PUBLIC_KEY_STATIC, CLIENT_PRIVATE_KEY_STATIC) if use_template else None
+        return lambda: [_initiation(template) for _ in range(n)]
+    return case
+
+
+def case_parse_response(n):
+    handshake_info, init_msg, _ = _initiation()
+    _, _, response = _response(init_msg)
+    return lambda: [encryption.parse_Server_Response(response, dict(handshake_info), CLIENT_PRIVATE_KEY_STATIC) for _ in range(n)]
+
+
+def case_full_handshake(n):
+    # Initiation + responder + response parsing + session setup, i.e. one complete handshake
+    template = encryption.HandshakeTemplate(SERVER_PUBLIC_KEY_STATIC, CLIENT_PRIVATE_KEY_STATIC)
+
+    def run():
+        for _ in range(n):
+            handshake_info, init_msg, _ = _initiation(template)
+            chain_key, _, response = _response(init_msg)
+            chain_key, handshake_info = encryption.parse_Server_Response(response, handshake_info, CLIENT_PRIVATE_KEY_STATIC)
+            encryption.TransportSession.from_handshake(chain_key, handshake_info)
+    return run
+
+
+def case_construct_transport(size):
+    def case(n):
+        handshake_info, chain_key, _, _ = _session_pair()
+        transport_keys = encryption.derive_transport_keys(chain_key)
+        payload = b'\x00' * size
+        return lambda: [encryption.construct_transport_message(transport_keys, handshake_info, payload) for _ in range(n)]
+    return case
+
+
+def _received_packets(server, size, n):
+    # At most PACKET_POOL distinct packets are generated; receivers reset their replay window each time they cycle
+    # returns a list of packet lists that add up to n packets
+    packets = [bytes(p) for p in server.encrypt_many([b'\x00' * size] * min(n, PACKET_POOL))]
+    full, rest = divmod(n, len(packets))
+    return [packets] * full + ([packets[:rest]] if rest else [])
+
+
+def case_consume_transport(size):
+    def case(n):
+        _, chain_key, client, server = _session_pair()
+        transport_keys = encryption.derive_transport_keys(chain_key)
+        cycles = _received_packets(server, size, n)
+
+        def run():
+            for packets in cycles:
+                transport_keys['replay_window'] = encryption.ReplayWindow()
+                for p in packets:
+                    encryption.consume_transport_message(p, transport_keys)
+        return run
+    return case
+
+
+def case_session_encrypt(size):
+    def case(n):
+        _, _, client, _ = _session_pair()
+        payload = b'\x00' * size
+        return lambda: [client.encrypt(payload) for _ in range(n)]
+    return case
+
+
+def case_session_decrypt(size):
+    def case(n):
+        _, _, client, server = _session_pair()
+        cycles = _received_packets(server, size, n)
+
+        def run():
+            for packets in cycles:
+                client.replay_window = encryption.ReplayWindow()
+                for p in packets:
+                    client.decrypt(p)
+        return run
+    return case
+
+
+def build_cases():
+    cases = {
+        'hash': case_hash,
+        'hmac': case_hmac,
+        'kdf1': case_kdf(encryption.Kdf1),
+        'kdf2': case_kdf(encryption.Kdf2),
+        'kdf3': case_kdf(encryption.Kdf3),
+        'timestamp': case_timestamp,
+        'initiation': case_initiation(False),
+        'initiation_template': case_initiation(True),
+        'parse_response': case_parse_response,
+        'handshake': case_full_handshake,
+    }
+    for size in PAYLOAD_SIZES:
+        cases[f'aead_encrypt_{size}'] = case_aead_encrypt(size)
+        cases[f'aead_decrypt_{size}'] = case_aead_decrypt(size)
+        cases[f'transport_construct_{size}'] = case_construct_transport(size)
+        cases[f'transport_consume_{size}'] = case_consume_transport(size)
+        cases[f'session_encrypt_{size}'] = case_session_encrypt(size)
+        cases[f'session_decrypt_{size}'] = case_session_decrypt(size)
+    return cases
+
+
+def calibrate(case, min_time):
+    # Grows the op count until one run takes min_time
+    n = 1
+    while True:
+        run = case(n)
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or n >= 1 << 20:
+            return n
+        n *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+
+def measure(cases, min_time, repeat):
+    # Times `repeat` rounds of one run per case, so a slow spell on the machine is spread over many cases instead of
+    # landing on every run of one; returns {name: (median ops/sec, noise)}, noise being the median absolute deviation
+    # relative to the median
+    sizes = {name: calibrate(case, min_time) for name, case in cases.items()}
+    rates = {name: [] for name in cases}
+    for _ in range(repeat):
+        for name, case in cases.items():
+            run = case(sizes[name])
+            start = time.perf_counter()
+            run()
+            rates[name].append(sizes[name] / (time.perf_counter() - start))
+
+    measured = {}
+    for name, runs in rates.items():
+        median = statistics.median(runs)
+        measured[name] = median, statistics.median(abs(rate - median) for rate in runs) / median
+    return measured
+
+
+def compare(results, baseline, threshold, noise=None, baseline_noise=None):
+    # returns the list of (name, baseline ops/sec, current ops/sec, change) that regressed by more than
+    # threshold plus NOISE_FACTOR times the larger noise of the two runs (baselines without noise figures count as 0)
+    noise = noise or {}
+    baseline_noise = baseline_noise or {}
+    regressions = []
+    for name, ops in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        change = (ops - base) / base
+        allowed = threshold + NOISE_FACTOR * max(noise.get(name, 0), baseline_noise.get(name, 0))
+        if change < -allowed:
+            regressions.append((name, base, ops, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the encryption primitives and handshake")
+    parser.add_argument('--filter', default='', help="only run cases whose name contains this string")
+    parser.add_argument('--min-time', type=float, default=0.1, help="minimum seconds per timed run")
+    parser.add_argument('--repeat', type=int, default=7, help="timed runs per case (the median is reported)")
+    parser.add_argument('--backend', help="AEAD backend to use (default: auto-selected)")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--save-baseline', help="write results to this file as the new baseline")
+    parser.add_argument('--baseline', help="compare against this baseline file")
+    parser.add_argument('--threshold', type=float, default=0.10, help="allowed slowdown vs baseline (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    backend = encryption.select_aead_backend(args.backend)
+
+    cases = {name: case for name, case in build_cases().items() if args.filter in name}
+    measured = measure(cases, args.min_time, args.repeat)
+    results = {name: ops for name, (ops, _) in measured.items()}
+    noise = {name: spread for name, (_, spread) in measured.items()}
+    for name in cases:
+        print(f"{name:28s} {results[name]:14,.0f} ops/s  \u00b1{noise[name]:5.1%}")
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'aead_backend': backend.name,
+        'results': results,
+        'noise': noise,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold, noise, baseline.get('noise'))
+        if regressions:
+            # measured again before failing the run: a regression has to show up twice
+            print(f"Re-measuring {len(regressions)} case(s) that look slower than the baseline")
+            measured = measure({name: cases[name] for name, *_ in regressions}, args.min_time, args.repeat)
+            regressions = compare({name: ops for name, (ops, _) in measured.items()}, baseline['results'],
+                                  args.threshold, {name: spread for name, (_, spread) in measured.items()},
+                                  baseline.get('noise'))
+        for name, base, ops, change in regressions:
+            print(f"REGRESSION {name}: {base:,.0f} -> {ops:,.0f} ops/s ({change:+.1%})")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.threshold:.0%} (plus noise) against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+"""
+End-to-end load benchmark for the chat client.
+
+Starts N ChatClient sessions against a chat server (by default a localChatServer.py started in a subprocess),
+has them join channels, then sends /CHANNEL_MESSAGE and /USER_MESSAGE traffic at a target rate.
+Reports throughput, send-to-receive latency percentiles and the handshake time distribution.
+Keys and the traffic schedule are derived from --seed, so runs with the same arguments do identical work.
+
+    python benchmarks/bench_load.py                                     # local server, default load
+    python benchmarks/bench_load.py --sessions 50 --rate 20 --duration 10
+    python benchmarks/bench_load.py --config client.json                # against another server (host, port, server key)
+    python benchmarks/bench_load.py --output results.json               # machine-readable results
+    python benchmarks/bench_load.py --save-baseline baseline.json       # store a baseline
+    python benchmarks/bench_load.py --baseline baseline.json            # compare, exit 1 on regression
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import encryption
+from chatClientFunctions import ChatClient, load_config
+
+# Message bodies are "load <sequence number> <perf_counter_ns at send>", so receivers can measure latency
+MESSAGE_PREFIX = 'load'
+
+# Metrics compared against a baseline: name -> True if higher is better
+COMPARED_METRICS = {
+    'throughput': True,
+    'latency_p50_ms': False,
+    'latency_p95_ms': False,
+    'latency_p99_ms': False,
+    'handshake_p50_ms': False,
+}
+
+
+def start_local_server(private_key):
+    # Runs localChatServer.py on a free port; returns (process, address, server public key)
+    process = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(ROOT, 'localChatServer.py'), '--port', '0',
+         '--private-key', base64.b64encode(private_key).decode()],
+        stdout=subprocess.PIPE, text=True)
+    host, port = process.stdout.readline().split()[-1].rsplit(':', 1)
+    public_key = base64.b64decode(process.stdout.readline().split()[-1])
+    return process, (host, int(port)), public_key
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of an already sorted list
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def distribution(values, scale=1000):
+    # p50/p95/p99/max/mean of a list of seconds, in milliseconds
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        'p50_ms': percentile(values, 50) * scale,
+        'p95_ms': percentile(values, 95) * scale,
+        'p99_ms': percentile(values, 99) * scale,
+        'max_ms': values[-1] * scale,
+        'mean_ms': sum(values) / len(values) * scale,
+    }
+
+
+def build_schedule(rng, sessions, channels, rate, duration, dm_ratio):
+    # Every session sends at `rate` messages/s with exponential gaps; returns [(time offset, sender, kind, target)]
+    schedule = []
+    for sender in range(sessions):
+        offset = rng.expovariate(rate)
+        while offset < duration:
+            if sessions > 1 and rng.random() < dm_ratio:
+                target = rng.choice([i for i in range(sessions) if i != sender])
+                schedule.append((offset, sender, 'dm', target))
+            else:
+                schedule.append((offset, sender, 'channel', sender % channels))
+            offset += rng.expovariate(rate)
+    schedule.sort()
+    return schedule
+
+
+class LoadSession:
+    # One ChatClient plus its listener thread, recording the latency of every message delivered to it
+
+    def __init__(self, index, client):
+        self.index = index
+        self.client = client
+        self.username = f"{MESSAGE_PREFIX}{index}"
+        self.latencies = []
+        self.received = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                msg = self.client.receive()
+            except OSError:
+                break
+            # copies that answer our own requests (they carry a request_handle) are not deliveries
+            if not isinstance(msg, dict) or msg.get('request_handle') is not None:
+                continue
+            if msg.get('response_type') not in (30, 33):
+                continue
+            parts = str(msg.get('message', '')).split(' ')
+            if len(parts) != 3 or parts[0] != MESSAGE_PREFIX:
+                continue
+            latency = (time.perf_counter_ns() - int(parts[2])) / 1e9
+            with self._lock:
+                self.latencies.append(latency)
+                self.received += 1
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    server_private_key = rng.randbytes(32)
+    client_keys = [rng.randbytes(32) for _ in range(args.sessions)]
+    schedule = build_schedule(rng, args.sessions, args.channels, args.rate, args.duration, args.dm_ratio)
+
+    backend = encryption.select_aead_backend(args.backend)
+
+    server = None
+    if args.config or args.host:
+        kwargs = load_config(args.config)
+        host, port = kwargs['server_address']
+        server_address = (args.host or host, args.port or port)
+        server_public_key = kwargs['server_public_key']
+    else:
+        server, server_address, server_public_key = start_local_server(server_private_key)
+
+    sessions = []
+    try:
+        # Handshakes one at a time, so each handshake time is measured without the others' load
+        connect_started = time.perf_counter()
+        for index, key in enumerate(client_keys):
+            client = ChatClient(server_address, server_public_key, key, keepalive_interval=3600)
+            sessions.append(LoadSession(index, client))
+        connect_time = time.perf_counter() - connect_started
+        handshake_times = [s.client.manager.stats.last_handshake_time for s in sessions]
+
+        # Usernames for DMs; the first session in each channel creates it, the others join
+        setup = [s.client.send_request("/SET_USERNAME", username=s.username) for s in sessions]
+        for s in sessions[:args.channels]:
+            setup.append(s.client.send_request("/CHANNEL_CREATE", channel=f"{MESSAGE_PREFIX}{s.index}", description="load test"))
+        for future in setup:
+            future.result()
+        setup = [s.client.send_request("/CHANNEL_JOIN", channel=f"{MESSAGE_PREFIX}{s.index % args.channels}")
+                 for s in sessions[args.channels:]]
+        for future in setup:
+            future.result()
+
+        members = [0] * args.channels
+        for s in sessions:
+            members[s.index % args.channels] += 1
+
+        # Traffic: one pacing thread follows the schedule; sends only queue the packet (ChatClient's sender thread)
+        expected = 0
+        started = time.perf_counter()
+        for seq, (offset, sender, kind, target) in enumerate(schedule):
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            client = sessions[sender].client
+            message = f"{MESSAGE_PREFIX} {seq} {time.perf_counter_ns()}"
+            if kind == 'dm':
+                client.send_request(12, to_username=sessions[target].username, message=message)
+                expected += 1
+            else:
+                client.send_request(9, channel=f"{MESSAGE_PREFIX}{target}", message=message)
+                expected += members[target] - 1
+        send_time = time.perf_counter() - started
+
+        # Let in-flight messages arrive
+        deadline = time.perf_counter() + args.drain
+        while time.perf_counter() < deadline and sum(s.received for s in sessions) < expected:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started
+
+        delivered = sum(s.received for s in sessions)
+        latencies = [latency for s in sessions for latency in s.latencies]
+        latency = distribution(latencies)
+        handshake = distribution(handshake_times)
+        results = {
+            'sent': len(schedule),
+            'send_rate': len(schedule) / send_time if send_time else 0,
+            'delivered': delivered,
+            'expected': expected,
+            'loss': 1 - delivered / expected if expected else 0,
+            'throughput': delivered / elapsed if elapsed else 0,
+            'connect_time_s': connect_time,
+        }
+        results.update({f'latency_{k}': v for k, v in latency.items()})
+        results.update({f'handshake_{k}': v for k, v in handshake.items()})
+    finally:
+        for s in sessions:
+            try:
+                s.client.request("/DISCONNECT")
+                s.client.close()
+            except Exception:
+                pass
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'aead_backend': backend.name,
+        'config': {
+            'sessions': args.sessions,
+            'channels': args.channels,
+            'rate': args.rate,
+            'duration': args.duration,
+            'dm_ratio': args.dm_ratio,
+            'seed': args.seed,
+            'server': 'local' if server is not None else f"{server_address[0]}:{server_address[1]}",
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    # returns the list of (name, baseline, current, change) that got worse by more than threshold
+    regressions = []
+    for name, higher_is_better in COMPARED_METRICS.items():
+        base, value = baseline.get(name), results.get(name)
+        if not base or value is None:
+            continue
+        change = (value - base) / base
+        if (change < -threshold) if higher_is_better else (change > threshold):
+            regressions.append((name, base, value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end load and latency benchmark for the chat client")
+    parser.add_argument('--sessions', type=int, default=20, help="number of client sessions")
+    parser.add_argument('--channels', type=int, default=4, help="channels the sessions are spread over")
+    parser.add_argument('--rate', type=float, default=10.0, help="messages per second per session")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds of traffic")
+    parser.add_argument('--dm-ratio', type=float, default=0.2, help="fraction of messages sent as /USER_MESSAGE")
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds to wait for in-flight messages afterwards")
+    parser.add_argument('--seed', type=int, default=1, help="seed for keys and the traffic schedule")
+    parser.add_argument('--config', help="client config (host, port, server_public_key) of the server to load")
+    parser.add_argument('--host', help="server host (default: start a local server)")
+    parser.add_argument('--port', type=int, help="server port")
+    parser.add_argument('--backend', help="AEAD backend to use (default: auto-selected)")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--save-baseline', help="write results to this file as the new baseline")
+    parser.add_argument('--baseline', help="compare against this baseline file")
+    parser.add_argument('--threshold', type=float, default=0.10, help="allowed change vs baseline (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+    args.channels = max(1, min(args.channels, args.sessions))
+
+    report = run(args)
+    for name, value in report['results'].items():
+        print(f"{name:20s} {value:14,.3f}" if isinstance(value, float) else f"{name:20s} {value:14,}")
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != report['config']:
+            print(f"Warning: {args.baseline} was recorded with a different configuration")
+        regressions = compare(report['results'], baseline['results'], args.threshold)
+        for name, base, value, change in regressions:
+            print(f"REGRESSION {name}: {base:,.3f} -> {value:,.3f} ({change:+.1%})")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+import asyncio
+import msgpack
+import time
+import encryption_manager
+from chatClientFunctions import (build_request, new_request_handle, pack_request, request_packet, RequestError, RequestTracker,
+                                 SERVER_ADDRESS, SERVER_PUBLIC_KEY, CLIENT_PRIVATE_KEY, REQUEST_TIMEOUT,
+                                 KEEPALIVE_INTERVAL, DEAD_PEER_PINGS)
+
+# asyncio-native chat client: one DatagramProtocol per session, no threads
+# Use this to run many sessions in one process (bots, load tests); ChatClient remains the threaded client used by the GUI
+# Requests go through the same RequestTracker as ChatClient's, driven here by an event loop timer instead of a thread
+
+class _LoopSender:
+    # Lets the EncryptionManager send (e.g. rekey initiations from its background thread) through the event loop
+    def __init__(self, loop, transport):
+        self.loop = loop
+        self.transport = transport
+
+    def send(self, data):
+        self.loop.call_soon_threadsafe(self.transport.sendto, bytes(data))
+
+class ChatClientProtocol(asyncio.DatagramProtocol):
+    # Hands every datagram to the owning AsyncChatClient
+
+    def __init__(self, client):
+        self.client = client
+
+    def connection_made(self, transport):
+        self.client.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.client._datagram_received(data)
+
+    def error_received(self, exc):
+        self.client._connection_error(exc)
+
+    def connection_lost(self, exc):
+        exc = exc or ConnectionError("Connection closed")
+        self.client._connection_error(exc)
+        self.client.tracker.fail_all(exc)
+
+class AsyncChatClient:
+
+    def __init__(self, server_address=SERVER_ADDRESS, server_public_key=SERVER_PUBLIC_KEY,
+                 private_key=CLIENT_PRIVATE_KEY, keepalive_interval=KEEPALIVE_INTERVAL,
+                 handshake_timeout=encryption_manager.HANDSHAKE_TIMEOUT,
+                 handshake_attempts=encryption_manager.HANDSHAKE_ATTEMPTS,
+                 reliable=False, dead_peer_pings=DEAD_PEER_PINGS, on_dead_peer=None):
+        self.server_address = server_address
+        self.server_public_key = server_public_key
+        self.private_key = private_key
+        self.keepalive_interval = keepalive_interval
+        self.handshake_timeout = handshake_timeout
+        self.handshake_attempts = handshake_attempts
+
+        self.transport = None
+        self.manager = None
+        self.session = None
+        self.welcome_message = None
+        self.running = False
+
+        self.last_sent = 0
+        self._messages = asyncio.Queue()
+        self._handshake_replies = None
+        self._keepalive_task = None
+
+        # In-flight requests; one loop timer, set for the tracker's next due time, retransmits (if reliable)
+        # and fails the ones that time out
+        # on_dead_peer(client) is called from the event loop when the server stops answering PINGs
+        self.reliable = reliable
+        self.on_dead_peer = on_dead_peer
+        self.tracker = RequestTracker(reliable, dead_peer_pings, on_dead_peer=self._dead_peer)
+        self.rtt = self.tracker.rtt
+        self._timer = None
+        self._timer_due = None
+
+    # Opens the endpoint, runs the handshake and the CONNECT request
+    # The endpoint is closed again if either fails (__aexit__ does not run when __aenter__ raises)
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: ChatClientProtocol(self), remote_addr=self.server_address)
+
+        try:
+            self.manager = encryption_manager.EncryptionManager(
+                self.server_public_key, self.private_key, _LoopSender(loop, self.transport), establish=False
+            )
+            await self._handshake()
+
+            # Initial connection request to the server; the response carries our session id
+            self.welcome_message = await self._connect_request()
+            self.session = self.welcome_message['session']
+        except BaseException:
+            self.transport.close()
+            raise
+
+        self.running = True
+        self._keepalive_task = asyncio.ensure_future(self._keepalive())
+        return self
+
+    # Both the handshake and CONNECT are retransmitted with jittered exponential backoff (as in ChatClient)
+    async def _handshake(self):
+        cookie_replies = 0
+        loop = asyncio.get_running_loop()
+        # replies are queued from the first initiation on, so none is missed while a bad one is being rejected
+        self._handshake_replies = asyncio.Queue()
+        for delay in encryption_manager.backoff_delays(self.handshake_timeout, self.handshake_attempts):
+            self._initiate()
+            deadline = loop.time() + delay
+            while True:
+                reply = await self._await_reply(deadline - loop.time())
+                if reply is None:
+                    break
+                try:
+                    if self.manager.complete_handshake(reply):
+                        self._handshake_replies = None
+                        return
+                except encryption_manager.InvalidHandshakeReply:
+                    # corrupted or forged: keep waiting for the real reply until this attempt times out
+                    continue
+                # cookie reply: the next initiation carries MAC2, and is sent straight away
+                cookie_replies += 1
+                if cookie_replies > encryption_manager.MAX_COOKIE_RETRIES:
+                    raise RuntimeError("Handshake failed: server kept answering with cookie replies")
+                self._initiate()
+                deadline = loop.time() + delay
+        raise TimeoutError(f"Handshake failed: no response from server after {self.handshake_attempts} attempts")
+
+    # Sends a fresh initiation
+    def _initiate(self):
+        self.transport.sendto(self.manager.begin_handshake())
+
+    # Waits up to `timeout` seconds for a reply to the pending initiation (None on timeout)
+    async def _await_reply(self, timeout):
+        if timeout <= 0:
+            return None
+        try:
+            reply = await asyncio.wait_for(self._handshake_replies.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    async def _connect_request(self):
+        packet = {'request_type': 1, 'request_handle': new_request_handle()}
+        for delay in encryption_manager.backoff_delays(self.handshake_timeout, self.handshake_attempts):
+            self._send(packet)
+            try:
+                return await asyncio.wait_for(self._messages.get(), delay)
+            except asyncio.TimeoutError:
+                continue
+        raise TimeoutError(f"CONNECT failed: no response from server after {self.handshake_attempts} attempts")
+
+    def _datagram_received(self, data):
+        # Replies to our own handshake go to the waiting _handshake(); everything else is decrypted
+        if self._handshake_replies is not None:
+            if self._is_handshake_reply(data):
+                self._handshake_replies.put_nowait(data)
+            return
+        result = self.manager.decrypt(data)
+        if result.kind != encryption_manager.TRANSPORT_DATA:
+            return
+        msg = msgpack.unpackb(result.payload, raw=False)
+        # only messages that answer no awaited request are queued for receive(), so the queue does not grow
+        # with responses (and keepalive PING replies) that request() already returned; duplicates are dropped
+        if self.tracker.response(msg) is False:
+            self._messages.put_nowait(msg)
+
+    def _is_handshake_reply(self, data):
+        # Replies to an earlier (retransmitted) initiation carry a stale index and are ignored
+        client_index = self.manager._pending_handshake['client_index']
+        return (data[0] == 2 and data[8:12] == client_index) or (data[0] == 3 and data[4:8] == client_index)
+
+    # ICMP errors (e.g. port unreachable) fail a handshake in progress; requests are left to their retransmissions and timeouts
+    def _connection_error(self, exc):
+        if self._handshake_replies is not None:
+            self._handshake_replies.put_nowait(exc)
+
+    # True while the server answers (see RequestTracker.ping_done)
+    @property
+    def peer_alive(self):
+        return self.tracker.peer_alive
+
+    def _dead_peer(self):
+        if self.on_dead_peer is not None:
+            self.on_dead_peer(self)
+
+    def _send(self, packet):
+        self.transport.sendto(bytes(self.manager.encrypt(pack_request(packet))))
+        self.last_sent = asyncio.get_running_loop().time()
+
+    # Same commands as ChatClient.request (e.g. "/CHANNEL_JOIN general")
+    # Returns the response message (None if the input was not a valid command); raises RequestError if the server
+    # answers with ERROR and TimeoutError if no response arrives within `timeout` seconds
+    async def request(self, userInput, timeout=REQUEST_TIMEOUT):
+        packet = build_request(self.session, userInput)
+        if packet:
+            return await self._submit(packet, timeout)
+
+    # Structured form of request(), e.g. await send_request("/CHANNEL_JOIN", channel="general")
+    async def send_request(self, request_type, timeout=REQUEST_TIMEOUT, **arguments):
+        return await self._submit(request_packet(self.session, request_type, **arguments), timeout)
+
+    # Sends a request and returns the future of its response; future.packet is the request and future.rtt its round trip
+    def _submit(self, packet, timeout):
+        if packet['request_type'] == 2:
+            self.running = False
+
+        future = asyncio.get_running_loop().create_future()
+        self.tracker.add(future, packet, timeout)
+        self._schedule_timer()
+        try:
+            self._send(packet)
+        except Exception as e:
+            self.tracker.discard(packet)
+            future.set_exception(e)
+        return future
+
+    # Keeps one loop timer set for the tracker's next due time
+    def _schedule_timer(self):
+        due = self.tracker.next_due()
+        if due is None or (self._timer is not None and self._timer_due <= due):
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_due = due
+        self._timer = asyncio.get_running_loop().call_later(max(0, due - time.monotonic()), self._run_timer)
+
+    def _run_timer(self):
+        self._timer = None
+        for packet in self.tracker.due():
+            try:
+                self._send(packet)
+            except Exception as e:
+                print(f"Retransmission failed: {e}")
+        self._schedule_timer()
+
+    # Decoded server messages that answer no request (channel messages, direct messages, server messages),
+    # in arrival order; responses are returned by request() instead
+    async def receive(self):
+        return await self._messages.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.running and self._messages.empty():
+            raise StopAsyncIteration
+        return await self._messages.get()
+
+    # Sends a PING once nothing has been sent for keepalive_interval seconds (as ChatClient.ping)
+    async def _keepalive(self):
+        loop = asyncio.get_running_loop()
+        while self.running:
+            idle = loop.time() - self.last_sent
+            if idle < self.keepalive_interval:
+                await asyncio.sleep(self.keepalive_interval - idle)
+                continue
+            try:
+                # tracked like any request, so PINGs feed the RTT estimate and dead-peer detection
+                future = self._submit(request_packet(self.session, 3), min(REQUEST_TIMEOUT, self.keepalive_interval))
+                future.add_done_callback(self.tracker.ping_done)
+            except Exception as e:
+                print(f"Ping failed: {e}")
+                await asyncio.sleep(self.keepalive_interval)
+
+    # Sends /DISCONNECT (if still connected), waiting up to `timeout` seconds for the reply, and closes the endpoint
+    # Requests still in flight fail with ConnectionError
+    async def close(self, timeout=1.0):
+        if self.running:
+            try:
+                await self.request("/DISCONNECT", timeout=timeout)
+            except (RequestError, TimeoutError, OSError):
+                pass
+        self.running = False
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+        if self._timer is not None:
+            self._timer.cancel()
+        self.tracker.fail_all(ConnectionError("Client closed"))
+        if self.transport is not None:
+            self.transport.close()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -5,191 +5,579 @@ import threading
 import time
 import socket
 import base64
+import itertools
+import json
+import os
+import heapq
+import queue
+from collections import OrderedDict
+from concurrent.futures import Future
 import encryption_manager
-import customtkinter as ctk
+
+# Default chat server and client identity
+SERVER_ADDRESS = ('csc4026z.link', 51820)
+SERVER_PUBLIC_KEY = b'f,^\xc0Cb\xf3\x937\xbf\x11\x14"\xed\x13\x0b\x9f\xe7\xaf;\x94\xb0p\x13\xe1\x94\xdd\x85\xcf\x01\x0bC'
+CLIENT_PRIVATE_KEY = base64.b64decode("2PmJnn14IPzuc2REgzUzs4YScgx3SuoA2rwp1TPV9Fc=")
+
+# Client configuration file (JSON), used by the headless client and bots instead of the defaults above:
+#   {"host": "127.0.0.1", "port": 51820, "server_public_key": "<base64>", "private_key": "<base64>"}
+# Every key is optional; the path can also come from the CHAT_CLIENT_CONFIG environment variable
+CONFIG_ENV = 'CHAT_CLIENT_CONFIG'
+
+# Reads a client config file and returns the matching ChatClient keyword arguments
+# (server_address, server_public_key, private_key); returns the defaults if there is no config file
+def load_config(path=None):
+    if path is None:
+        path = os.environ.get(CONFIG_ENV)
+    config = {}
+    if path:
+        with open(path) as f:
+            config = json.load(f)
+
+    host, port = SERVER_ADDRESS
+    return {
+        'server_address': (config.get('host', host), int(config.get('port', port))),
+        'server_public_key': base64.b64decode(config['server_public_key']) if 'server_public_key' in config else SERVER_PUBLIC_KEY,
+        'private_key': base64.b64decode(config['private_key']) if 'private_key' in config else CLIENT_PRIVATE_KEY,
+    }
+
+# Seconds a request waits for its response before its future fails with TimeoutError
+REQUEST_TIMEOUT = 5.0
+
+# Read-only requests (PING, CHANNEL_LIST, CHANNEL_INFO, WHOIS, WHOAMI, USER_LIST): safe to send twice,
+# so the reliability layer retransmits them (with the same request_handle) when the response is late
+IDEMPOTENT_REQUESTS = frozenset((3, 5, 6, 10, 11, 14))
+
+# Retransmission timer bounds (seconds); the RFC's 1s floor is lowered since the chat server answers from memory
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = encryption_manager.MAX_RETRANSMIT_TIMEOUT
+
+# Handles of retransmitted requests that have been answered, remembered so that the late copies of their
+# response (one per transmission) are dropped instead of being shown twice
+ANSWERED_RETRANSMITS = 256
+
+class RttEstimator:
+    """
+    Smoothed round-trip time and retransmission timeout, as in RFC 6298
+    Fed with the round trips of PINGs and requests that were not retransmitted (Karn's algorithm)
+    """
+
+    def __init__(self, initial_rto=INITIAL_RTO, min_rto=MIN_RTO, max_rto=MAX_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.samples = 0
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+        self.samples += 1
+
+class _PendingRequest:
+    # One in-flight request; next_send is when it is due for retransmission (None if it is never retransmitted)
+    __slots__ = ('future', 'packet', 'sent', 'deadline', 'next_send', 'retransmits')
+
+    def __init__(self, future, packet, sent, deadline, next_send):
+        self.future = future
+        self.packet = packet
+        self.sent = sent
+        self.deadline = deadline
+        self.next_send = next_send
+        self.retransmits = 0
+
+# Keepalive: a PING is sent once nothing has been sent for KEEPALIVE_INTERVAL seconds,
+# and the server is considered dead after DEAD_PEER_PINGS PINGs in a row go unanswered
+KEEPALIVE_INTERVAL = 30
+DEAD_PEER_PINGS = 3
+
+# Outbound queue: capacity, and what send() does when it is full
+#   'block'       waits for space
+#   'drop_oldest' discards the oldest queued packet to make room
+#   'fail_fast'   raises SendQueueFull
+SEND_QUEUE_SIZE = 1024
+SEND_POLICIES = ('block', 'drop_oldest', 'fail_fast')
+
+class SendQueueFull(Exception):
+    pass
+
+class RequestError(Exception):
+    # Set on a request's future when the server answers with ERROR (response type 20); .response is the full message
+    def __init__(self, response):
+        super().__init__(response.get('error', 'Unknown error'))
+        self.response = response
+
+class RequestTracker:
+    """
+    In-flight requests of one client, matched to their responses by request_handle
+    Shared by ChatClient (threads) and chatClientAsync.AsyncChatClient (event loop), which each drive it with their own timer:
+    add() when a request is sent, response() for every message received, due() once next_due() has passed
+    Also does retransmission timing for reliable clients (RFC 6298 with Karn's algorithm) and dead-peer detection
+    """
+
+    def __init__(self, reliable=False, dead_peer_pings=DEAD_PEER_PINGS, on_dead_peer=None):
+        self.reliable = reliable
+        self.rtt = RttEstimator()
+        self.dead_peer_pings = dead_peer_pings
+        self.on_dead_peer = on_dead_peer
+        self.peer_alive = True
+        self.missed_pings = 0
+
+        # request_handle -> _PendingRequest, a heap of (due time, request_handle), and the handles of retransmitted
+        # requests already answered (later copies of their response are duplicates)
+        # changed is notified whenever an earlier due time is added or the tracker is cleared
+        self.changed = threading.Condition()
+        self._pending = {}
+        self._deadlines = []
+        self._answered_retransmits = OrderedDict()
+
+    def __len__(self):
+        return len(self._pending)
+
+    # Registers a request before it is sent, so even an immediate response finds its future
+    # future may be a concurrent.futures.Future or an asyncio future; future.packet is set to the request
+    # and future.rtt to its round trip once answered
+    def add(self, future, packet, timeout):
+        future.packet = packet
+        future.rtt = None
+        handle = packet['request_handle']
+        sent = time.monotonic()
+        deadline = sent + timeout
+        next_send = None
+        if self.reliable and packet['request_type'] in IDEMPOTENT_REQUESTS:
+            next_send = sent + self.rtt.rto
+        with self.changed:
+            self._pending[handle] = _PendingRequest(future, packet, sent, deadline, next_send)
+            heapq.heappush(self._deadlines, (min(deadline, next_send or deadline), handle))
+            self.changed.notify_all()
+
+    # Forgets a request that could not be sent
+    def discard(self, packet):
+        with self.changed:
+            self._pending.pop(packet['request_handle'], None)
+
+    # Earliest time due() has work to do, or None if nothing is in flight
+    def next_due(self):
+        with self.changed:
+            return self._deadlines[0][0] if self._deadlines else None
+
+    # Handles one received message: any message proves the server is alive, and a response resolves its request's future
+    # Returns True if it answered a pending request, False otherwise (None for a duplicate response to a
+    # retransmitted request that was already answered, which should be dropped)
+    def response(self, msg):
+        self.missed_pings = 0
+        self.peer_alive = True
+        handle = msg.get('request_handle') if isinstance(msg, dict) else None
+        if handle is None:
+            return False
+        with self.changed:
+            request = self._pending.pop(handle, None)
+            if request is None:
+                return None if handle in self._answered_retransmits else False
+            if request.retransmits:
+                self._answered_retransmits[handle] = None
+                if len(self._answered_retransmits) > ANSWERED_RETRANSMITS:
+                    self._answered_retransmits.popitem(last=False)
+
+        future = request.future
+        if future.done():
+            return True
+        future.rtt = time.monotonic() - request.sent
+        # Karn: the round trip of a retransmitted request is ambiguous, so it is not sampled
+        if request.retransmits == 0:
+            self.rtt.update(future.rtt)
+        if msg.get('response_type') == 20:
+            future.set_exception(RequestError(msg))
+        else:
+            future.set_result(msg)
+        return True
+
+    # Fails the requests whose timeout has passed and returns the packets due for retransmission
+    # (same request_handle, the interval doubling each time)
+    def due(self):
+        expired = []
+        resend = []
+        with self.changed:
+            now = time.monotonic()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                handle = heapq.heappop(self._deadlines)[1]
+                request = self._pending.get(handle)
+                if request is None:
+                    continue
+                if now >= request.deadline:
+                    del self._pending[handle]
+                    expired.append(request.future)
+                    continue
+                request.retransmits += 1
+                request.next_send = now + min(self.rtt.rto * 2 ** request.retransmits, self.rtt.max_rto)
+                heapq.heappush(self._deadlines, (min(request.deadline, request.next_send), handle))
+                resend.append(request.packet)
+
+        for future in expired:
+            if not future.done():
+                future.set_exception(TimeoutError(f"No response to request {future.packet['request_handle']}"))
+        return resend
+
+    # Fails every request still in flight (the client is closing)
+    def fail_all(self, exc):
+        with self.changed:
+            pending = list(self._pending.values())
+            self._pending.clear()
+            self._deadlines.clear()
+            self.changed.notify_all()
+        for request in pending:
+            if not request.future.done():
+                request.future.set_exception(exc)
+
+    # Done callback for keepalive PING futures: on_dead_peer() is called once dead_peer_pings PINGs in a row time out
+    def ping_done(self, future):
+        if future.cancelled():
+            return
+        exception = future.exception()
+        if exception is None:
+            self.missed_pings = 0
+            self.peer_alive = True
+            return
+        if not isinstance(exception, TimeoutError):
+            return
+        self.missed_pings += 1
+        if self.missed_pings >= self.dead_peer_pings and self.peer_alive:
+            self.peer_alive = False
+            print(f"[ERROR] Server not responding ({self.missed_pings} PINGs unanswered)")
+            if self.on_dead_peer is not None:
+                self.on_dead_peer()
+
+# Chat commands: /COMMAND -> (request_type, arguments as (name, type) pairs, error shown when arguments are missing)
+# Arguments are taken from user input in order; the last argument of a two-argument command gets the rest of the line
+COMMANDS = {
+    "/SET_USERNAME":    (13, (('username', str),), "requires a username argument"),
+    "/USER_LIST":       (14, (('offset', int),), "requires an offset argument (e.g., /USER_LIST 0)"),
+    "/DISCONNECT":      (2, (), None),
+    "/WHOAMI":          (11, (), None),
+    "/USER_MESSAGE":    (12, (('to_username', str), ('message', str)), "requires a to_username and message argument"),
+    "/WHOIS":           (10, (('username', str),), "requires a username argument"),
+    "/CHANNEL_CREATE":  (4, (('channel', str), ('description', str)), "requires a channel and description argument"),
+    "/CHANNEL_LIST":    (5, (('offset', int),), "requires an offset argument (e.g., /CHANNEL_LIST 0)"),
+    "/CHANNEL_INFO":    (6, (('channel', str),), "requires a channel argument"),
+    "/CHANNEL_JOIN":    (7, (('channel', str),), "requires a channel argument"),
+    "/CHANNEL_LEAVE":   (8, (('channel', str),), "requires a channel argument"),
+    "/CHANNEL_MESSAGE": (9, (('channel', str), ('message', str)), "requires a channel and message argument"),
+}
+
+# request_type -> arguments, for requests built from structured arguments (PING has no command of its own)
+REQUEST_ARGUMENTS = {request_type: arguments for request_type, arguments, _ in COMMANDS.values()}
+REQUEST_ARGUMENTS[3] = ()
+
+# Request handles count up from a random start: unique within the process, and much cheaper than random.randint
+_request_handles = itertools.count(random.randrange(2**32))
+
+def new_request_handle():
+    return next(_request_handles) & 0xFFFFFFFF
+
+# msgpack Packers are not thread-safe, so every thread reuses its own
+_packers = threading.local()
+
+def pack_request(packet):
+    packer = getattr(_packers, 'packer', None)
+    if packer is None:
+        packer = _packers.packer = msgpack.Packer()
+    return packer.pack(packet)
+
+# Builds a request packet (a dict, before msgpack) from structured arguments, e.g.
+#   request_packet(session, 7, channel="general")
+# request_type may also be a command name ("/CHANNEL_JOIN"); raises ValueError for unknown types or missing/invalid arguments
+def request_packet(session, request_type, **arguments):
+    if isinstance(request_type, str):
+        if request_type not in COMMANDS:
+            raise ValueError(f"Unknown command {request_type}")
+        request_type = COMMANDS[request_type][0]
+    schema = REQUEST_ARGUMENTS.get(request_type)
+    if schema is None:
+        raise ValueError(f"Unknown request type {request_type}")
+
+    packet = {
+        'request_type': request_type,
+        'session': session,
+        'request_handle': new_request_handle()
+    }
+    for name, convert in schema:
+        if name not in arguments:
+            raise ValueError(f"Missing argument '{name}'")
+        packet[name] = convert(arguments[name])
+    return packet
+
+# Builds the request packet for a line of user input
+# User input is split into the command and arguments; returns None if the command is unknown or incomplete
+def build_request(session, userInput):
+    split = userInput.split(" ", maxsplit = 2)
+    requestType = split[0]
+    command = COMMANDS.get(requestType)
+    if command is None:
+        return None
+
+    request_type, arguments, usage = command
+    values = split[1:]
+    if len(values) < len(arguments):
+        print(f"[ERROR] {requestType} {usage}")
+        return None
+
+    try:
+        return request_packet(session, request_type, **{name: value for (name, _), value in zip(arguments, values)})
+    except ValueError:
+        print(f"[ERROR] Invalid argument(s) for command: {requestType}")
+        return None
 
 class ChatClient:
-    def __init__(self):
+    # server_address/server_public_key/private_key default to the course server; point them at a
+    # localChatServer.LocalChatServer to run offline
+    # reliable=True retransmits read-only requests (IDEMPOTENT_REQUESTS) whose response is later than the RTO
+    def __init__(self, server_address=SERVER_ADDRESS, server_public_key=SERVER_PUBLIC_KEY, private_key=CLIENT_PRIVATE_KEY,
+                 handshake_timeout=encryption_manager.HANDSHAKE_TIMEOUT, handshake_attempts=encryption_manager.HANDSHAKE_ATTEMPTS,
+                 reliable=False, send_queue_size=SEND_QUEUE_SIZE, send_policy='block',
+                 keepalive_interval=KEEPALIVE_INTERVAL, dead_peer_pings=DEAD_PEER_PINGS, on_dead_peer=None):
+        if send_policy not in SEND_POLICIES:
+            raise ValueError(f"send_policy must be one of {SEND_POLICIES}")
+
         # Client-Server Connection and Thread Initiation
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.connect(('csc4026z.link', 51820))
-        
-        server_public_key = b'f,^\xc0Cb\xf3\x937\xbf\x11\x14"\xed\x13\x0b\x9f\xe7\xaf;\x94\xb0p\x13\xe1\x94\xdd\x85\xcf\x01\x0bC'
-        private_key =  base64.b64decode("2PmJnn14IPzuc2REgzUzs4YScgx3SuoA2rwp1TPV9Fc=")
+        self.sock.connect(server_address)
 
         # encyption_manager init handles all encryption establishing proccesses
-        self.manager = encryption_manager.EncryptionManager(server_public_key, private_key, self.sock) 
+        self.manager = encryption_manager.EncryptionManager(server_public_key, private_key, self.sock,
+                                                            handshake_timeout=handshake_timeout,
+                                                            handshake_attempts=handshake_attempts)
 
         # Initial connection request to the server
-        packet = msgpack.packb({'request_type':1, 'request_handle': random.randint(0, 2**32 - 1)})
-        self.sock.send(self.manager.encrypt(packet))
-        
         # Server respond with session id, which is stored globally
-        data, _ = self.sock.recvfrom(4096)
-        plaintext = self.manager.decrypt(data)
+        plaintext = self.connect(handshake_timeout, handshake_attempts)
         self.session = msgpack.unpackb(plaintext)['session']
         self.welcome_message = msgpack.unpackb(plaintext) # Welcome message from CONNECT response, passed to chatClientGUI
 
         self.running = True # False when /DISCONNECT is called
-        self.ping_thread = threading.Thread(target=self.ping, daemon=True) # Thread that send a PING every 30 seconds
+
+        # In-flight requests: responses resolve their future in receive(); the expiry thread retransmits (if reliable)
+        # and fails the ones that time out
+        # on_dead_peer(client) is called (from the request expiry thread) when the server stops answering PINGs
+        self.reliable = reliable
+        self.on_dead_peer = on_dead_peer
+        self.tracker = RequestTracker(reliable, dead_peer_pings, on_dead_peer=self._dead_peer)
+        self.rtt = self.tracker.rtt
+        self.expiry_thread = threading.Thread(target=self._expire_requests, daemon=True)
+        self.expiry_thread.start()
+
+        # Outgoing packets are queued and encrypted/sent by one sender thread, in queue order,
+        # so callers (e.g. the Tk main thread) never wait on encryption or the socket
+        self.send_policy = send_policy
+        self._send_queue = queue.Queue(send_queue_size)
+        self._send_stats_lock = threading.Lock()
+        self._send_stats = {'enqueued': 0, 'sent': 0, 'dropped': 0, 'rejected': 0, 'send_errors': 0, 'max_depth': 0}
+        self.sender_thread = threading.Thread(target=self._send_loop, daemon=True)
+        self.sender_thread.start()
+
+        # Keepalive state: last_sent is updated by the sender thread, _stop_event wakes the ping thread on shutdown
+        self.keepalive_interval = keepalive_interval
+        self.last_sent = time.monotonic()
+        self._stop_event = threading.Event()
+
+        self.ping_thread = threading.Thread(target=self.ping, daemon=True) # Thread that sends a PING whenever the client is idle
         self.ping_thread.start()
-    
-    # Method that handles all user requests
-    # User input is split into the command and arguments
-    def request(self, userInput):
-        split = userInput.split(" ", maxsplit = 2)
-        requestType = split[0]
-        packet = {}
 
+    # Sends the CONNECT request and waits for the response, retransmitting with jittered exponential backoff
+    # Raises TimeoutError if the server does not answer after `attempts` tries
+    def connect(self, timeout, attempts):
+        packet = pack_request({'request_type':1, 'request_handle': new_request_handle()})
         try:
-            if requestType == "/SET_USERNAME":
-                if len(split) < 2:
-                    print("[ERROR] /SET_USERNAME requires a username argument")
-                    return
-                username = split[1]
-                packet = {
-                    'request_type': 13,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1),
-                    'username': username
-                }
-            elif requestType == "/USER_LIST":
-                if len(split) < 2:
-                    print("[ERROR] /USER_LIST requires an offset argument (e.g., /USER_LIST 0)")
-                    return
-                offset = split[1]
-                packet = {
-                    'request_type': 14,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1),
-                    'offset': int(offset)
-                }
-            elif requestType == "/DISCONNECT":
-                packet = {
-                    'request_type': 2,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1)
-                }
-                self.running = False
-            elif requestType == "/WHOAMI":
-                packet = {
-                    'request_type': 11,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1)
-                }
-            elif requestType == "/USER_MESSAGE":  # /USER_MESSAGE <to_username> <message>
-                if len(split) < 3:
-                    print("[ERROR] /USER_MESSAGE requires a to_username and message argument")
-                    return
-                to_username = split[1]
-                message = split[2]
-                packet = {
-                    'request_type': 12,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1),
-                    'to_username': to_username,
-                    'message': message
-                }
-            elif requestType == "/WHOIS":
-                if len(split) < 2:
-                    print("[ERROR] /WHOIS requires a username argument")
-                    return
-                username = split[1]
-                packet = {
-                    'request_type': 10,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1),
-                    'username': username
-                }
-            elif requestType == "/CHANNEL_CREATE":
-                if len(split) < 3:
-                    print("[ERROR] /CHANNEL_CREATE requires a channel and description argument")
-                    return
-                channel = split[1]
-                description = split[2]
-                packet = {
-                    'request_type': 4,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1),
-                    'channel': channel,
-                    'description': description
-                }
-            elif requestType == "/CHANNEL_LIST":
-                offset = split[1]
-                packet = {
-                    'request_type': 5,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1),
-                    'offset': int(offset)
-                }
-            elif requestType == "/CHANNEL_INFO":
-                if len(split) < 2:
-                    print("[ERROR] /CHANNEL_INFO requires a channel argument")
-                    return
-                channel = split[1]
-                packet = {
-                    'request_type': 6,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1),
-                    'channel': channel
-                }
-            elif requestType == "/CHANNEL_JOIN":
-                if len(split) < 2:
-                    print("[ERROR] /CHANNEL_JOIN requires a channel argument")
-                    return
-                channel = split[1]
-                packet = {
-                    'request_type': 7,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1),
-                    'channel': channel
-                }
-            elif requestType == "/CHANNEL_LEAVE":
-                if len(split) < 2:
-                    print("[ERROR] /CHANNEL_LEAVE requires a channel argument")
-                    return
-                channel = split[1]
-                packet = {
-                    'request_type': 8,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1),
-                    'channel': channel
-                }
-            elif requestType == "/CHANNEL_MESSAGE":
-                if len(split) < 3:
-                    print("[ERROR] /CHANNEL_MESSAGE requires a channel and message argument")
-                    return
-                channel = split[1]
-                message = split[2]
-                packet = {
-                    'request_type': 9,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1),
-                    'channel': channel,
-                    'message': message
-                }
+            for delay in encryption_manager.backoff_delays(timeout, attempts):
+                self.sock.send(self.manager.encrypt(packet))
+                deadline = time.monotonic() + delay
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.sock.settimeout(remaining)
+                    try:
+                        data, _ = self.sock.recvfrom(4096)
+                    except socket.timeout:
+                        break
+                    result = self.manager.decrypt(data)
+                    if result.kind == encryption_manager.TRANSPORT_DATA:
+                        return result.payload
+        finally:
+            self.sock.settimeout(None)
 
+        raise TimeoutError(f"CONNECT failed: no response from server after {attempts} attempts")
+    
+    # Method that handles all user requests
+    # The packet is built by build_request, then encrypted and sent
+    # Returns a Future for the response (None if the input was not a valid command), see send_request
+    def request(self, userInput, timeout=REQUEST_TIMEOUT):
+        try:
+            packet = build_request(self.session, userInput)
             if packet:
-                encrypted_packet = self.manager.encrypt(msgpack.packb(packet))
-                self.sock.send(encrypted_packet)
+                return self._submit(packet, timeout)
 
-        except IndexError:
-            print(f"[ERROR] Missing argument(s) for command: {requestType}")
         except Exception as e:
             print(f"[ERROR] Failed to build/send request: {e}")
 
-    # Ping method to keep session alive by sending a PING message to the server every 30
-    # Method is killed when /DISCONNECT is called
+    # Programmatic counterpart of request(): takes a request type (or command name) and its arguments directly,
+    # e.g. client.send_request("/CHANNEL_JOIN", channel="general")
+    # Returns a concurrent.futures.Future that resolves to the matching response message, or fails with RequestError
+    # (server ERROR) or TimeoutError after `timeout` seconds; future.packet is the request and future.rtt its round trip
+    def send_request(self, request_type, timeout=REQUEST_TIMEOUT, **arguments):
+        return self._submit(request_packet(self.session, request_type, **arguments), timeout)
+
+    def _submit(self, packet, timeout):
+        if packet['request_type'] == 2:
+            self.running = False
+            self._stop_event.set()
+
+        future = Future()
+        self.tracker.add(future, packet, timeout)
+        try:
+            self.send(packet)
+        except Exception as e:
+            self.tracker.discard(packet)
+            future.set_exception(e)
+        return future
+
+    # True while the server answers (see RequestTracker.ping_done)
+    @property
+    def peer_alive(self):
+        return self.tracker.peer_alive
+
+    def _dead_peer(self):
+        if self.on_dead_peer is not None:
+            self.on_dead_peer(self)
+
+    # Resolves the future of the request a response answers (matched by request_handle)
+    # Returns False for messages that answer no pending request (e.g. channel messages from other users)
+    def handle_response(self, msg):
+        return bool(self.tracker.response(msg))
+
+    # Receives and decodes one message from the server, resolving its request's future first
+    # Returns None for datagrams that carry no message (rekey handshake replies, junk)
+    # and for duplicate responses to retransmitted requests
+    def receive(self):
+        data, _ = self.sock.recvfrom(4096)
+        result = self.manager.decrypt(data)
+        if result.kind != encryption_manager.TRANSPORT_DATA:
+            return None
+        msg = msgpack.unpackb(result.payload, raw=False)
+        if self.tracker.response(msg) is None:
+            return None
+        return msg
+
+    # Runs the request tracker's timer: retransmits late requests and fails the ones that time out
+    # Runs until the client has disconnected and no request is left in flight
+    def _expire_requests(self):
+        tracker = self.tracker
+        while True:
+            with tracker.changed:
+                if not self.running and not len(tracker):
+                    return
+                due = tracker.next_due()
+                now = time.monotonic()
+                if due is None or due > now:
+                    tracker.changed.wait(None if due is None else due - now)
+                    continue
+            for packet in tracker.due():
+                try:
+                    self.send(packet)
+                except Exception as e:
+                    print(f"Retransmission failed: {e}")
+
+    # Queues a packet for the sender thread; a full queue is handled according to send_policy
+    def send(self, packet: dict):
+        send_queue = self._send_queue
+        if self.send_policy == 'block':
+            send_queue.put(packet)
+        elif self.send_policy == 'fail_fast':
+            try:
+                send_queue.put_nowait(packet)
+            except queue.Full:
+                with self._send_stats_lock:
+                    self._send_stats['rejected'] += 1
+                raise SendQueueFull(f"Send queue full ({send_queue.maxsize} packets)")
+        else:
+            while True:
+                try:
+                    send_queue.put_nowait(packet)
+                    break
+                except queue.Full:
+                    try:
+                        send_queue.get_nowait()
+                    except queue.Empty:
+                        continue
+                    with self._send_stats_lock:
+                        self._send_stats['dropped'] += 1
+
+        depth = send_queue.qsize()
+        with self._send_stats_lock:
+            self._send_stats['enqueued'] += 1
+            if depth > self._send_stats['max_depth']:
+                self._send_stats['max_depth'] = depth
+
+    # Sender thread: encrypts and writes queued packets in order, so nonces follow queue order
+    def _send_loop(self):
+        while True:
+            packet = self._send_queue.get()
+            if packet is None:
+                break
+            try:
+                self.sock.send(self.manager.encrypt(pack_request(packet)))
+            except Exception as e:
+                if self.sock.fileno() == -1:
+                    # socket closed
+                    break
+                print(f"[ERROR] Failed to send request: {e}")
+                with self._send_stats_lock:
+                    self._send_stats['send_errors'] += 1
+                continue
+            self.last_sent = time.monotonic()
+            with self._send_stats_lock:
+                self._send_stats['sent'] += 1
+
+    # Send queue metrics: current depth, high-water mark and packet counts
+    def send_queue_stats(self):
+        with self._send_stats_lock:
+            stats = dict(self._send_stats)
+        stats['depth'] = self._send_queue.qsize()
+        stats['capacity'] = self._send_queue.maxsize
+        return stats
+
+    # Lets the sender thread flush what is queued (e.g. a final /DISCONNECT), then closes the socket
+    # Requests still in flight fail with ConnectionError, and the expiry thread exits
+    def close(self, timeout=1.0):
+        self.running = False
+        self._stop_event.set()
+        try:
+            self._send_queue.put(None, timeout=timeout)
+            self.sender_thread.join(timeout)
+        except queue.Full:
+            pass
+        self.sock.close()
+        self.tracker.fail_all(ConnectionError("Client closed"))
+
+    # Keepalive thread: sends a PING only once nothing has been sent for keepalive_interval seconds,
+    # so a busy client sends none; exits as soon as the client disconnects or is closed
     def ping(self):
-        while self.running:
+        wait = self.keepalive_interval
+        while not self._stop_event.wait(wait):
+            idle = time.monotonic() - self.last_sent
+            if idle < self.keepalive_interval:
+                wait = self.keepalive_interval - idle
+                continue
+            wait = self.keepalive_interval
             try:
-                packet = {
-                    'request_type': 3,
-                    'session': self.session,
-                    'request_handle': random.randint(0, 2**32 - 1)
-                }
-                self.sock.send(self.manager.encrypt(msgpack.packb(packet)))
+                # sent as a tracked request, so every PING also feeds the RTT estimate
+                future = self._submit(request_packet(self.session, 3), min(REQUEST_TIMEOUT, self.keepalive_interval))
+                future.add_done_callback(self.tracker.ping_done)
             except Exception as e:
                 print(f"Ping failed: {e}")
-                # Optional: break or set self.running = False if needed
-            time.sleep(30)
@@ -5,7 +5,6 @@
 import customtkinter as ctk
 import threading
 from threading import Event
-import msgpack
 from PIL import Image
 import datetime
 
@@ -21,7 +20,7 @@ class ChatClientGUI:
         self.root.geometry("1280x720")
 
         #Create the ChatClient instance
-        self.client = ChatClient()         
+        self.client = ChatClient(reliable=True)
         self.user_offset = 0
         self.channel_offset = 0
         self.cached_users = []
@@ -73,7 +72,7 @@ class ChatClientGUI:
             if self.connected:
                 # Disconnect
                 self.client.request("/DISCONNECT")
-                self.client.sock.close()
+                self.client.close()
                 self.connected = False
                 self.conn_button.configure(text="CONNECT", fg_color="green")
                 self.show_info("[{0}] 🔌 Disconnected from server.".format(datetime.datetime.now().strftime("%H:%M:%S")))
@@ -338,17 +337,31 @@ class ChatClientGUI:
             self.show_info("Error: Both channel name and description are required to create a channel.")
             return
         self.show_info(f"Attempting to create channel: {name} ...")
-        self.client.request(f"/CHANNEL_CREATE {name} {desc}")
+        created = self.client.request(f"/CHANNEL_CREATE {name} {desc}")
         self.create_channel_entry.delete(0, 'end')
         self.create_channel_desc_entry.delete(0, 'end')
-        # Update the channel list after a short delay
-        self.root.after(500, self.fetch_channels)
-        # Automatically join the new channel after short delay (to allow creation)
-        def join_created_channel():
-            self.client.request(f"/CHANNEL_JOIN {name}")
+        if created is None:
+            return
+
+        # Once the server confirms the channel: refresh the channel list and join it
+        # Future callbacks run on the listener thread, so the work is handed back to Tk with after(0, ...)
+        def on_joined(future):
+            if future.exception() is not None:
+                self.show_info(f"Error: Could not join channel '{name}': {future.exception()}")
+                return
             self.current_channel = name
             self.show_info(f"✅ Channel '{name}' created successfully!\n🔗 Automatically joined new channel: {name}")
-        self.root.after(800, join_created_channel)
+
+        def on_created(future):
+            if future.exception() is not None:
+                self.show_info(f"Error: Could not create channel '{name}': {future.exception()}")
+                return
+            self.fetch_channels()
+            joined = self.client.request(f"/CHANNEL_JOIN {name}")
+            if joined is not None:
+                joined.add_done_callback(lambda f: self.root.after(0, on_joined, f))
+
+        created.add_done_callback(lambda f: self.root.after(0, on_created, f))
 
     # Autocomplete functionality for input entry
     def autocomplete(self, event):
@@ -380,9 +393,11 @@ class ChatClientGUI:
         import datetime
         while not self._stop_event.is_set():
             try:
-                data, _ = self.client.sock.recvfrom(4096)
-                plaintext = self.client.manager.decrypt(data)
-                msg = msgpack.unpackb(plaintext, raw=False)
+                # receive() also resolves the future of the request this message answers
+                msg = self.client.receive()
+                if msg is None:
+                    # Control packet (e.g. rekey handshake response) handled by the encryption manager, or junk
+                    continue
                 print(msg)
                 now = datetime.datetime.now().strftime("%H:%M:%S")
                 display = None
@@ -652,12 +667,12 @@ Note: Offsets are used for pagination. Use /HELP any time to show this message.
             #cleanly shut down existing client
             try:
                 self.client.request("/DISCONNECT")
-                self.client.sock.close()
+                self.client.close()
             except:
                 pass
 
             # re-create and re-initialize ChatClient (runs CONNECT handshake)
-            self.client = ChatClient()
+            self.client = ChatClient(reliable=True)
 
             #reset GUI state
             self.current_channel = None
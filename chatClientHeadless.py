@@ -0,0 +1,83 @@
+import argparse
+import json
+import sys
+import threading
+import encryption
+from chatClientFunctions import ChatClient, load_config
+
+# Runs ChatClient without the GUI (no Tk import), for bots, scripts and bulk senders
+#
+#   python chatClientHeadless.py --config bot.json                       commands from stdin, one per line
+#   python chatClientHeadless.py -c "/CHANNEL_JOIN general" -c "/CHANNEL_MESSAGE general hi"
+#   python chatClientHeadless.py --config bot.json --daemon              stay connected, print incoming messages
+#
+# Server messages are printed to stdout as JSON lines; see chatClientFunctions.load_config for the config format
+
+def print_message(msg):
+    sys.stdout.write(json.dumps(msg, default=str) + "\n")
+    sys.stdout.flush()
+
+def listen(client):
+    while True:
+        try:
+            msg = client.receive()
+        except OSError:
+            break
+        if msg is not None:
+            print_message(msg)
+
+# Sends one command and waits for its response; returns False if it failed
+def run_command(client, command, timeout):
+    future = client.request(command, timeout=timeout)
+    if future is None:
+        return False
+    try:
+        future.result()
+    except Exception as e:
+        print(f"[ERROR] {command}: {e}", file=sys.stderr)
+        return False
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless chat client")
+    parser.add_argument("--config", help="JSON client config (host, port, server_public_key, private_key)")
+    parser.add_argument("--host", help="overrides the configured server host")
+    parser.add_argument("--port", type=int, help="overrides the configured server port")
+    parser.add_argument("--aead-backend", help="AEAD backend to use (skips the startup benchmark)")
+    parser.add_argument("-c", "--command", action="append", default=[], help="command to send (repeatable)")
+    parser.add_argument("--daemon", action="store_true", help="stay connected after the commands and print incoming messages")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds to wait for each command's response")
+    args = parser.parse_args()
+
+    kwargs = load_config(args.config)
+    host, port = kwargs['server_address']
+    kwargs['server_address'] = (args.host or host, args.port or port)
+
+    if args.aead_backend:
+        encryption.select_aead_backend(args.aead_backend)
+
+    client = ChatClient(reliable=True, **kwargs)
+    print_message(client.welcome_message)
+    threading.Thread(target=listen, args=(client,), daemon=True).start()
+
+    ok = all([run_command(client, command, args.timeout) for command in args.command])
+    try:
+        if args.daemon:
+            threading.Event().wait()
+        elif not args.command:
+            for line in sys.stdin:
+                line = line.strip()
+                if line:
+                    run_command(client, line, args.timeout)
+                if line.startswith("/DISCONNECT"):
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if client.running:
+            client.request("/DISCONNECT")
+        client.close()
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,37 @@
 
 import hashlib
 import nacl.bindings
+import nacl.exceptions
 import nacl.public
 import hmac
 import time
 import math
 import secrets
 import struct
+import os
+import threading
+from collections import deque
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
 
 
 # CONSTANTS
 LABELMAC1 = b'mac1----'
+LABELCOOKIE = b'cookie--'
 CONSTRUCTION = b'Noise_IKpsk2_25519_ChaChaPoly_BLAKE2s'
 IDENTIFIER = b'WireGuard v1 zx2c4 Jason@zx2c4.com'
 # Raw server public key (as a 32-byte WireGuard-style static key)
 SERVER_STATIC_PUBLIC_KEY = b'f,^\xc0Cb\xf3\x937\xbf\x11\x14"\xed\x13\x0b\x9f\xe7\xaf;\x94\xb0p\x13\xe1\x94\xdd\x85\xcf\x01\x0bC'
 Q = b'\x00' * 32
+# Transport limits - Section 5.4.6 / 6.1
+REKEY_AFTER_MESSAGES = 2**60
+REJECT_AFTER_MESSAGES = 2**64 - 2**13 - 1
+REKEY_AFTER_TIME = 120
+REJECT_AFTER_TIME = 180
+REKEY_TIMEOUT = 5
+COOKIE_LIFETIME = 120
+REPLAY_WINDOW_SIZE = 2048
 # SERVER_STATIC_PUBLIC_KEY=b'f,^\xc0Cb\xf3\x937\xbf\x11\x14"\xed\x13\x0b\x9f\xe7\xaf;\x94\xb0p\x13\xe1\x94\xdd\x85\xcf\x01\x0bC'
 
 # AUX FUNCTIONS 
@@ -44,6 +58,52 @@ def DH_Generate():
     public_key = private_key.public_key
     return private_key.encode(), public_key.encode()
 
+class EphemeralKeyPool:
+    """
+    Pool of pre-generated single-use ephemeral keypairs, refilled by a background thread
+    Keeps keypair generation off the handshake's critical path; each keypair is handed out exactly once
+    A forked child starts from an empty pool with its own refill thread, so it never reuses the parent's keys
+    """
+
+    def __init__(self, size=8):
+        self.size = size
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._keys = deque()
+        self._wanted = threading.Condition(threading.Lock())
+        self._refill_thread = None
+
+    def _refill(self):
+        while self._pid == os.getpid():
+            with self._wanted:
+                while len(self._keys) >= self.size:
+                    self._wanted.wait()
+            keypair = DH_Generate()
+            with self._wanted:
+                self._keys.append(keypair)
+
+    def start(self):
+        # Starts the background refill thread (idempotent)
+        if self._pid != os.getpid():
+            # forked: the inherited keys belong to the parent, and the refill thread did not survive the fork
+            self._reset()
+        with self._wanted:
+            if self._refill_thread is None:
+                self._refill_thread = threading.Thread(target=self._refill, daemon=True)
+                self._refill_thread.start()
+
+    def get(self):
+        # Returns (private_key, public_key); generates inline if the pool has run dry
+        self.start()
+        with self._wanted:
+            keypair = self._keys.popleft() if self._keys else None
+            self._wanted.notify()
+        if keypair is None:
+            keypair = DH_Generate()
+        return keypair
+
 def HMAC(key, data):
     # Computes HMAC using blake2s
     return hmac.new(key, data, hashlib.blake2s).digest()
@@ -69,14 +129,185 @@ def Kdf3(key, input):
     tau3 = HMAC(tau0, tau2 + b'\x03')
     return tau1, tau2, tau3
 
+# AEAD BACKENDS
+# All backends implement ChaCha20-Poly1305 (RFC 8439) with the same interface:
+#   encrypt(key, nonce, plaintext, authtext) / decrypt(key, nonce, ciphertext, authtext)
+#   cipher(key) -> keyed object with encrypt(nonce, data, authtext) / decrypt(nonce, data, authtext)
+# decrypt raises cryptography's InvalidTag when the packet fails to authenticate, whichever backend is active
+
+class _KeyedCipher:
+    # Binds a key to a backend that has no native keyed cipher object
+    __slots__ = ('backend', 'key')
+
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+
+    def encrypt(self, nonce, data, authtext):
+        return self.backend.encrypt(self.key, nonce, data, authtext)
+
+    def decrypt(self, nonce, data, authtext):
+        return self.backend.decrypt(self.key, nonce, data, authtext)
+
+class LibsodiumAEAD:
+    # libsodium through PyNaCl
+    name = 'libsodium'
+
+    def encrypt(self, key, nonce, plaintext, authtext):
+        if not isinstance(plaintext, bytes):
+            plaintext = bytes(plaintext)
+        return nacl.bindings.crypto_aead_chacha20poly1305_ietf_encrypt(plaintext, authtext, nonce, key)
+
+    def decrypt(self, key, nonce, ciphertext, authtext):
+        # libsodium's bindings only take bytes, so views over received packets are copied here
+        if not isinstance(ciphertext, bytes):
+            ciphertext = bytes(ciphertext)
+        try:
+            return nacl.bindings.crypto_aead_chacha20poly1305_ietf_decrypt(ciphertext, authtext, nonce, key)
+        except nacl.exceptions.CryptoError:
+            raise InvalidTag() from None
+
+    def cipher(self, key):
+        return _KeyedCipher(self, key)
+
+class OpenSSLAEAD:
+    # OpenSSL through cryptography. Its cipher objects take buffers and (from cryptography 45) support encrypt_into
+    name = 'openssl'
+
+    def encrypt(self, key, nonce, plaintext, authtext):
+        return ChaCha20Poly1305(key).encrypt(nonce, plaintext, authtext)
+
+    def decrypt(self, key, nonce, ciphertext, authtext):
+        return ChaCha20Poly1305(key).decrypt(nonce, ciphertext, authtext)
+
+    def cipher(self, key):
+        return ChaCha20Poly1305(key)
+
+class ReferenceAEAD:
+    # Pure-Python RFC 8439 implementation. Far too slow for real traffic, only used to cross-check the other backends
+    name = 'reference'
+
+    @staticmethod
+    def _chacha20_block(key_words, counter, nonce_words):
+        state = [0x61707865, 0x3320646e, 0x79622d32, 0x6b206574] + key_words + [counter] + nonce_words
+        x = list(state)
+        for _ in range(10):
+            for a, b, c, d in ((0, 4, 8, 12), (1, 5, 9, 13), (2, 6, 10, 14), (3, 7, 11, 15),
+                               (0, 5, 10, 15), (1, 6, 11, 12), (2, 7, 8, 13), (3, 4, 9, 14)):
+                x[a] = (x[a] + x[b]) & 0xffffffff; x[d] ^= x[a]; x[d] = ((x[d] << 16) | (x[d] >> 16)) & 0xffffffff
+                x[c] = (x[c] + x[d]) & 0xffffffff; x[b] ^= x[c]; x[b] = ((x[b] << 12) | (x[b] >> 20)) & 0xffffffff
+                x[a] = (x[a] + x[b]) & 0xffffffff; x[d] ^= x[a]; x[d] = ((x[d] << 8) | (x[d] >> 24)) & 0xffffffff
+                x[c] = (x[c] + x[d]) & 0xffffffff; x[b] ^= x[c]; x[b] = ((x[b] << 7) | (x[b] >> 25)) & 0xffffffff
+        return struct.pack('<16I', *((x[i] + state[i]) & 0xffffffff for i in range(16)))
+
+    def _chacha20_xor(self, key, counter, nonce, data):
+        key_words = list(struct.unpack('<8I', key))
+        nonce_words = list(struct.unpack('<3I', nonce))
+        out = bytearray(len(data))
+        for block_start in range(0, len(data), 64):
+            keystream = self._chacha20_block(key_words, counter + block_start // 64, nonce_words)
+            chunk = data[block_start:block_start + 64]
+            out[block_start:block_start + len(chunk)] = bytes(a ^ b for a, b in zip(chunk, keystream))
+        return bytes(out)
+
+    @staticmethod
+    def _poly1305(key, msg):
+        r = int.from_bytes(key[:16], 'little') & 0x0ffffffc0ffffffc0ffffffc0fffffff
+        s = int.from_bytes(key[16:], 'little')
+        p = (1 << 130) - 5
+        acc = 0
+        for i in range(0, len(msg), 16):
+            block = msg[i:i + 16] + b'\x01'
+            acc = ((acc + int.from_bytes(block, 'little')) * r) % p
+        return ((acc + s) & ((1 << 128) - 1)).to_bytes(16, 'little')
+
+    def _tag(self, key, nonce, ciphertext, authtext):
+        one_time_key = self._chacha20_block(list(struct.unpack('<8I', key)), 0, list(struct.unpack('<3I', nonce)))[:32]
+        mac_data = (authtext + b'\x00' * (-len(authtext) % 16) +
+                    ciphertext + b'\x00' * (-len(ciphertext) % 16) +
+                    struct.pack('<QQ', len(authtext), len(ciphertext)))
+        return self._poly1305(one_time_key, mac_data)
+
+    def encrypt(self, key, nonce, plaintext, authtext):
+        ciphertext = self._chacha20_xor(key, 1, nonce, bytes(plaintext))
+        return ciphertext + self._tag(key, nonce, ciphertext, bytes(authtext))
+
+    def decrypt(self, key, nonce, ciphertext, authtext):
+        ciphertext = bytes(ciphertext)
+        if len(ciphertext) < 16:
+            raise InvalidTag()
+        ciphertext, tag = ciphertext[:-16], ciphertext[-16:]
+        if not hmac.compare_digest(tag, self._tag(key, nonce, ciphertext, bytes(authtext))):
+            raise InvalidTag()
+        return self._chacha20_xor(key, 1, nonce, ciphertext)
+
+    def cipher(self, key):
+        return _KeyedCipher(self, key)
+
+AEAD_BACKENDS = {
+    'libsodium': LibsodiumAEAD,
+    'openssl': OpenSSLAEAD,
+    'reference': ReferenceAEAD,
+}
+# Environment override for the backend choice (skips the startup benchmark)
+AEAD_BACKEND_ENV = 'CHAT_AEAD_BACKEND'
+# Payload sizes the startup benchmark is run over (typical msgpack requests up to a full UDP datagram)
+AEAD_BENCHMARK_SIZES = (64, 256, 1024)
+
+_aead_backend = None
+
+def benchmark_aead_backends(payload_sizes=AEAD_BENCHMARK_SIZES, iterations=200, backends=('libsodium', 'openssl')):
+    # Times an encrypt+decrypt round trip for each backend over the given payload sizes
+    # returns {backend name: seconds}
+    key = b'\x01' * 32
+    nonce = b'\x00' * 12
+    results = {}
+    for name in backends:
+        backend = AEAD_BACKENDS[name]()
+        cipher = backend.cipher(key)
+        start = time.perf_counter()
+        for size in payload_sizes:
+            payload = b'\x00' * size
+            for _ in range(iterations):
+                cipher.decrypt(nonce, cipher.encrypt(nonce, payload, b''), b'')
+        results[name] = time.perf_counter() - start
+    return results
+
+def select_aead_backend(override=None, payload_sizes=AEAD_BENCHMARK_SIZES):
+    """
+    Picks the AEAD backend used by AEAD_encrypt/AEAD_decrypt and new transport sessions
+    An explicit override (or the CHAT_AEAD_BACKEND environment variable) wins, otherwise the fastest
+    backend in a short benchmark over payload_sizes is chosen
+    """
+    global _aead_backend
+    if override is None:
+        override = os.environ.get(AEAD_BACKEND_ENV)
+
+    if override:
+        if override not in AEAD_BACKENDS:
+            raise ValueError(f"Unknown AEAD backend '{override}' (expected one of {', '.join(AEAD_BACKENDS)})")
+        name = override
+    else:
+        timings = benchmark_aead_backends(payload_sizes)
+        name = min(timings, key=timings.get)
+
+    _aead_backend = AEAD_BACKENDS[name]()
+    return _aead_backend
+
+def get_aead_backend():
+    # Returns the active backend, selecting one on first use
+    if _aead_backend is None:
+        return select_aead_backend()
+    return _aead_backend
+
 def AEAD_encrypt(key, counter, plaintext, authtext):
     # Encrypts the data with a key. Only people with the key can decrypt the data again. 
     # Also checks if the message is authentic
-    return nacl.bindings.crypto_aead_chacha20poly1305_ietf_encrypt(plaintext, authtext, counter, key)
+    return (_aead_backend or get_aead_backend()).encrypt(key, counter, plaintext, authtext)
 
 def AEAD_decrypt(key, counter, ciphertext, authtext):
     # Decrypts the data with a key. Also checks that the message is authentic. 
-    return nacl.bindings.crypto_aead_chacha20poly1305_ietf_decrypt(ciphertext, authtext, counter, key)
+    return (_aead_backend or get_aead_backend()).decrypt(key, counter, ciphertext, authtext)
 
 def Timestamp(unix_time=None):
     # Get Unix time
@@ -114,17 +345,77 @@ def get_MAC1(server_public_key, msg):
     # Generates MAC1 according to WireGuard spec. Used for checking message integrity
     return MAC(MixHash(LABELMAC1, server_public_key), msg)
 
-def get_MAC2():
-    return b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+def get_MAC2(cookie=None, msg=None):
+    # Generates MAC2 according to WireGuard spec. Without a (fresh) cookie from the server, MAC2 is all zeros
+    # msg is everything before MAC2 (i.e. including MAC1)
+    if cookie is None:
+        return b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+    return MAC(cookie, msg)
+
+# Cookie Reply - Section 5.4.7
+
+def consume_Cookie_Reply(reply_message: bytes, server_public_key_static: bytes, mac1: bytes, cookie_key: bytes = None):
+    """
+    Decrypts a cookie reply (message type 3) sent by a responder under load
+    mac1 is the MAC1 of the initiation the reply answers; cookie_key may be passed in from a HandshakeTemplate
+    returns the receiver index and the 16-byte cookie to use for MAC2 on the next initiation
+    """
+    if len(reply_message) != 64 or reply_message[0] != 3:
+        raise ValueError("Not a cookie reply message")
+
+    # Dividing into sub-fields
+    receiver = reply_message[4:8]
+    nonce = reply_message[8:32]
+    encrypted_cookie = reply_message[32:64]
+
+    if cookie_key is None:
+        cookie_key = MixHash(LABELCOOKIE, server_public_key_static)
+
+    cookie = nacl.bindings.crypto_aead_xchacha20poly1305_ietf_decrypt(encrypted_cookie, mac1, nonce, cookie_key)
+    return receiver, cookie
 
 # Initiation Message - Section 5.4.2
 
-def get_Initiation_Message(server_public_key_static, client_private_key_static, client_private_key_ephemeral=None, client_public_key_ephemeral=None, timestamp_input=None, sender_index=None):
+class HandshakeTemplate:
+    """
+    Caches the parts of an initiation handshake that only depend on the (client static key, server static key) pair:
+    the initial chain key and hash, the static-static DH, the client static public key and the MAC1 key.
+    Build one per server and pass it to get_Initiation_Message so each handshake only does the ephemeral work.
+    """
+
+    def __init__(self, server_public_key_static, client_private_key_static):
+        self.server_public_key_static = server_public_key_static
+        self.client_private_key_static = client_private_key_static
+
+        # Initial chain key and hash (Hash(CONSTRUCTION), then MixHash over IDENTIFIER and the server static key)
+        self.chain_key = Hash(CONSTRUCTION)
+        hash = MixHash(self.chain_key, IDENTIFIER)
+        self.hash = MixHash(hash, server_public_key_static)
+
+        # Static-static DH and the client static public key never change for this pair
+        self.static_common_key = DH(client_private_key_static, server_public_key_static)
+        self.client_public_key_static = nacl.public.PrivateKey(client_private_key_static).public_key.encode()
+
+        # Key used for MAC1 on every initiation sent to this server, and the key its cookie replies are encrypted with
+        self.mac1_key = MixHash(LABELMAC1, server_public_key_static)
+        self.cookie_key = MixHash(LABELCOOKIE, server_public_key_static)
+
+    def matches(self, server_public_key_static, client_private_key_static):
+        # Checks that the template was built for the given key pair
+        return (self.server_public_key_static == server_public_key_static and
+                self.client_private_key_static == client_private_key_static)
+
+
+def get_Initiation_Message(server_public_key_static, client_private_key_static, client_private_key_ephemeral=None, client_public_key_ephemeral=None, timestamp_input=None, sender_index=None, template=None, cookie=None):
     # Implementation of an initiation handshake as per WireGuard specs. 
+    # The per-server work is taken from a HandshakeTemplate (built here if the caller did not supply one)
+    # cookie is the last (unexpired) cookie received from the server, used for MAC2
+    if template is None or not template.matches(server_public_key_static, client_private_key_static):
+        template = HandshakeTemplate(server_public_key_static, client_private_key_static)
+
     # First get the hash and the chain key
-    chain_key = Hash(CONSTRUCTION)
-    hash = MixHash(chain_key, IDENTIFIER)
-    hash = MixHash(hash, server_public_key_static)
+    chain_key = template.chain_key
+    hash = template.hash
 
     # Generate ephemeral private and public keys (note: for unit testing, we allow for test-injecting keys, hence the if-statement)
     if client_private_key_ephemeral is None or client_public_key_ephemeral is None:
@@ -138,16 +429,12 @@ def get_Initiation_Message(server_public_key_static, client_private_key_static,
     common_key = DH(client_private_key_ephemeral, server_public_key_static)
     chain_key, key1 = Kdf2(chain_key, common_key)
 
-    # Derrive client public key
-    client_public_key_static = nacl.public.PrivateKey(client_private_key_static).public_key.encode()
-    
     # Encrypt static public key
-    msg_static_encrypted = AEAD_encrypt(key1, b'\x00' * 12, client_public_key_static, hash)
+    msg_static_encrypted = AEAD_encrypt(key1, b'\x00' * 12, template.client_public_key_static, hash)
     hash = MixHash(hash, msg_static_encrypted)
 
-    # Perform DH() to get new common key (the other way around)
-    common_key = DH(client_private_key_static, server_public_key_static)
-    chain_key, key2 = Kdf2(chain_key, common_key)
+    # Mix in the (precomputed) static-static DH
+    chain_key, key2 = Kdf2(chain_key, template.static_common_key)
 
     # Encrypt the timestamp
     if timestamp_input is None:
@@ -178,19 +465,10 @@ def get_Initiation_Message(server_public_key_static, client_private_key_static,
         encrypted_timestamp
         )
     
-    mac1 = get_MAC1(server_public_key_static, msg)
-    mac2 = get_MAC2()
+    mac1 = MAC(template.mac1_key, msg)
+    mac2 = get_MAC2(cookie, msg + mac1)
 
-    final_message = (
-        msg_type + 
-        reserved + 
-        sender_index + 
-        client_public_key_ephemeral + 
-        msg_static_encrypted + 
-        encrypted_timestamp + 
-        mac1 + 
-        mac2
-        )
+    final_message = msg + mac1 + mac2
     
     # Define a ds to keep track of handshake throughout the process
     handshake_info = {
@@ -198,7 +476,8 @@ def get_Initiation_Message(server_public_key_static, client_private_key_static,
         'hash' : hash,
         'client_index': sender_index,
         'server_index': None,
-        'client_private_key_ephemeral': client_private_key_ephemeral
+        'client_private_key_ephemeral': client_private_key_ephemeral,
+        'mac1': mac1
     }
         
     return handshake_info, final_message, msg
@@ -255,6 +534,141 @@ def parse_Server_Response(response_message: bytes, handshake_info: dict, client_
 
     return chain_key, handshake_info
 
+# Responder side of the handshake - Sections 5.4.2 and 5.4.3
+# Mirrors get_Initiation_Message/parse_Server_Response so the protocol can be driven offline (local server, benchmarks)
+
+def consume_Initiation_Message(initiation_message: bytes, server_private_key_static: bytes, server_public_key_static: bytes = None):
+    """
+    Validates and decrypts a handshake initiation as the responder
+    returns a responder handshake dict (chain_key, hash, indices, initiator keys and timestamp)
+    raises ValueError if the message is malformed or MAC1 does not match
+    """
+    if len(initiation_message) != 148 or initiation_message[0] != 1:
+        raise ValueError("Not a handshake initiation message")
+
+    if server_public_key_static is None:
+        server_public_key_static = nacl.public.PrivateKey(server_private_key_static).public_key.encode()
+
+    # Dividing into sub-fields
+    sender_index = initiation_message[4:8]
+    client_public_key_ephemeral = initiation_message[8:40]
+    msg_static_encrypted = initiation_message[40:88]
+    encrypted_timestamp = initiation_message[88:116]
+    mac1 = initiation_message[116:132]
+
+    if not hmac.compare_digest(mac1, get_MAC1(server_public_key_static, initiation_message[:116])):
+        raise ValueError("Handshake initiation has an invalid MAC1")
+
+    chain_key = Hash(CONSTRUCTION)
+    hash = MixHash(chain_key, IDENTIFIER)
+    hash = MixHash(hash, server_public_key_static)
+
+    chain_key = Kdf1(chain_key, client_public_key_ephemeral)
+    hash = MixHash(hash, client_public_key_ephemeral)
+
+    # Recover the initiator's static key
+    common_key = DH(server_private_key_static, client_public_key_ephemeral)
+    chain_key, key1 = Kdf2(chain_key, common_key)
+    client_public_key_static = AEAD_decrypt(key1, b'\x00' * 12, msg_static_encrypted, hash)
+    hash = MixHash(hash, msg_static_encrypted)
+
+    # Recover the timestamp
+    common_key = DH(server_private_key_static, client_public_key_static)
+    chain_key, key2 = Kdf2(chain_key, common_key)
+    timestamp = AEAD_decrypt(key2, b'\x00' * 12, encrypted_timestamp, hash)
+    hash = MixHash(hash, encrypted_timestamp)
+
+    return {
+        'chain_key': chain_key,
+        'hash': hash,
+        'client_index': sender_index,
+        'client_public_key_static': client_public_key_static,
+        'client_public_key_ephemeral': client_public_key_ephemeral,
+        'timestamp': timestamp,
+    }
+
+def get_Server_Response(responder_info: dict, server_private_key_ephemeral=None, server_public_key_ephemeral=None, sender_index=None):
+    """
+    Builds the handshake response for a consumed initiation (the counterpart of parse_Server_Response)
+    returns the final chain_key, the responder's own index and the response message
+    """
+    chain_key = responder_info['chain_key']
+    hash = responder_info['hash']
+
+    # Generate ephemeral keys (test-injectable, as in get_Initiation_Message)
+    if server_private_key_ephemeral is None or server_public_key_ephemeral is None:
+        server_private_key_ephemeral, server_public_key_ephemeral = DH_Generate()
+
+    chain_key = Kdf1(chain_key, server_public_key_ephemeral)
+    hash = MixHash(hash, server_public_key_ephemeral)
+
+    chain_key = Kdf1(chain_key, DH(server_private_key_ephemeral, responder_info['client_public_key_ephemeral']))
+    chain_key = Kdf1(chain_key, DH(server_private_key_ephemeral, responder_info['client_public_key_static']))
+
+    chain_key, tmp, key3 = Kdf3(chain_key, Q)
+    hash = MixHash(hash, tmp)
+
+    empty_encrypted = AEAD_encrypt(key3, b'\x00' * 12, b'', hash)
+
+    if sender_index is None:
+        sender_index = secrets.token_bytes(4)
+    else:
+        sender_index = sender_index.to_bytes(4, byteorder='little')
+
+    msg = (
+        b'\x02' +
+        b'\x00' * 3 +
+        sender_index +
+        responder_info['client_index'] +
+        server_public_key_ephemeral +
+        empty_encrypted
+        )
+    final_message = msg + get_MAC1(responder_info['client_public_key_static'], msg) + get_MAC2()
+
+    return chain_key, sender_index, final_message
+
+# Replay protection - Section 5.4.6
+
+class ReplayError(ValueError):
+    # Raised when a transport counter is a duplicate or too old to be accepted
+    pass
+
+class ReplayWindow:
+    """
+    Sliding-window replay filter for received transport counters (as in WireGuard / RFC 6479).
+    Bit i of the bitmap records whether counter (greatest - i) has been seen, so both checks are O(1).
+    check() is done before the AEAD decrypt, update() only once the packet has authenticated.
+    """
+
+    def __init__(self, size=REPLAY_WINDOW_SIZE):
+        self.size = size
+        self.mask = (1 << size) - 1
+        self.greatest = -1
+        self.bitmap = 0
+
+    def check(self, counter):
+        # Returns True if the counter is new and inside the window
+        if counter >= REJECT_AFTER_MESSAGES:
+            return False
+        if counter > self.greatest:
+            return True
+        offset = self.greatest - counter
+        if offset >= self.size:
+            return False
+        return not (self.bitmap >> offset) & 1
+
+    def update(self, counter):
+        # Marks the counter as seen, sliding the window forward if it is the highest so far
+        if counter > self.greatest:
+            shift = counter - self.greatest
+            if shift >= self.size:
+                self.bitmap = 1
+            else:
+                self.bitmap = ((self.bitmap << shift) | 1) & self.mask
+            self.greatest = counter
+        else:
+            self.bitmap |= 1 << (self.greatest - counter)
+
 # Transport Key Derivation - Section 5.4.5
 
 def derive_transport_keys(chain_key):
@@ -267,68 +681,186 @@ def derive_transport_keys(chain_key):
         'T_client_sending': T_client_sending,
         'T_client_receiving': T_client_receiving,
         'N_client_sending': 0,
-        'N_client_receiving': 0
+        'N_client_receiving': 0,
+        'replay_window': ReplayWindow()
     }
 
     return transport_keys
 
 #  Transport Data Messages - Section 5.4.6
 
+# Fixed 16-byte transport header: type, 3 reserved bytes, receiver index, little-endian counter
+TRANSPORT_HEADER = struct.Struct('<B3x4sQ')
+# 12-byte AEAD nonce: 4 zero bytes followed by the little-endian counter
+TRANSPORT_NONCE = struct.Struct('<4xQ')
+AEAD_TAG_SIZE = 16
+
+def pack_transport_message(key, receiver_index, counter, payload):
+    """
+    Encrypts a payload and frames it as a transport packet
+    The header is packed straight into a preallocated buffer, so the only copy is the ciphertext itself
+    """
+    encrypted_payload = AEAD_encrypt(key, TRANSPORT_NONCE.pack(counter), payload, b'')
+
+    packet = bytearray(TRANSPORT_HEADER.size + len(encrypted_payload))
+    TRANSPORT_HEADER.pack_into(packet, 0, 4, receiver_index, counter)
+    packet[TRANSPORT_HEADER.size:] = encrypted_payload
+    return packet
+
+def unpack_transport_header(input_data):
+    """
+    Parses the transport header in place
+    returns (msg_type, receiver_index, counter, encrypted_data) where encrypted_data is a memoryview (no copy)
+    """
+    msg_type, receiver_index, counter = TRANSPORT_HEADER.unpack_from(input_data)
+    return msg_type, receiver_index, counter, memoryview(input_data)[TRANSPORT_HEADER.size:]
+
 def construct_transport_message(transport_keys: dict, handshake_info: dict, payload): 
     """
     This method constructs a transport message (packet) according to WireGuard spec
     returns the packet (with encrypted payload + header info) and updated handshake_info (used in the session)
     """
     
-    msg_type = b'\x04' #This message type means 'send'
-    reserved = b'\x00' * 3
-    reciever_index = handshake_info['server_index']
-    counter = transport_keys['N_client_sending'].to_bytes(8, 'little')
-    nonce = b'\x00\x00\x00\x00' + counter
-
-    # perform encryption on payload
-    encrypted_payload = AEAD_encrypt(transport_keys['T_client_sending'],
-                                    nonce,
-                                    payload,
-                                    b''
-                                    )
-    
-    # construct the transport message
-    transport_message = (msg_type + 
-                         reserved + 
-                         reciever_index + 
-                         counter + 
-                         encrypted_payload
-                         )
+    counter = transport_keys['N_client_sending']
+
+    # perform encryption on payload and frame the transport message
+    transport_message = pack_transport_message(transport_keys['T_client_sending'],
+                                               handshake_info['server_index'],
+                                               counter,
+                                               payload
+                                               )
 
     # update the counter
-    transport_keys['N_client_sending'] += 1
+    transport_keys['N_client_sending'] = counter + 1
 
     return transport_keys, transport_message
 
 def consume_transport_message(input_data, transport_keys: dict):
     """
     This method accepts packets from the server and consumes and decrypts them
+    Duplicate and out-of-window counters raise ReplayError before any decryption is attempted
     """
 
-    # Split packet into different components
-    msg_type = input_data[0]
-    reserved = input_data[1:4]
-    client_index = input_data[4: 8]
-    counter_bytes = input_data[8:16]
-    encrypted_data = input_data[16:]
+    # Parse the header without copying the encrypted data
+    msg_type, client_index, counter, encrypted_data = unpack_transport_header(input_data)
 
-    counter = int.from_bytes(counter_bytes, 'little')
-    nonce = b'\x00\x00\x00\x00' + counter_bytes
+    # cheap replay check before paying for the decrypt
+    replay_window = transport_keys['replay_window']
+    if not replay_window.check(counter):
+        raise ReplayError(f"Rejected replayed or stale transport counter {counter}")
 
     # perform the decrypt 
     decrypted_data = AEAD_decrypt(transport_keys['T_client_receiving'], 
-                                  nonce,
+                                  TRANSPORT_NONCE.pack(counter),
                                   encrypted_data,
                                   b'') 
     
-    # increment the counter
+    # only authenticated packets move the window
+    replay_window.update(counter)
     if counter > transport_keys['N_client_receiving']:
         transport_keys['N_client_receiving'] = counter
 
-    return decrypted_data, transport_keys
\ No newline at end of file
+    return decrypted_data, transport_keys
+
+# Transport Sessions
+
+class TransportSession:
+    """
+    Compact holder for one direction-pair of transport state (keys, counters, indices and replay window)
+    The AEAD cipher objects are built once here (from the active backend) instead of on every packet
+    """
+
+    __slots__ = ('sending_key', 'receiving_key', 'sending_counter', 'receiving_counter',
+                 'sender_index', 'receiver_index', 'replay_window', '_send_cipher', '_recv_cipher',
+                 '_encrypt_into', 'created', '_counter_lock')
+
+    def __init__(self, sending_key, receiving_key, sender_index, receiver_index):
+        self.sending_key = sending_key
+        self.receiving_key = receiving_key
+        self.sending_counter = 0
+        self.receiving_counter = 0
+        self.sender_index = sender_index      # our index, carried in packets sent to us
+        self.receiver_index = receiver_index  # peer's index, carried in packets we send
+        self.replay_window = ReplayWindow()
+        self.created = time.monotonic()
+        self._counter_lock = threading.Lock()
+        backend = get_aead_backend()
+        self._send_cipher = backend.cipher(sending_key)
+        self._recv_cipher = backend.cipher(receiving_key)
+        # encrypt_into (OpenSSL backend, cryptography >= 45) writes straight into the packet buffer
+        self._encrypt_into = getattr(self._send_cipher, 'encrypt_into', None)
+
+    @classmethod
+    def from_handshake(cls, chain_key, handshake_info: dict):
+        # Builds the initiator's session from a completed handshake
+        transport_keys = derive_transport_keys(chain_key)
+        return cls(transport_keys['T_client_sending'],
+                   transport_keys['T_client_receiving'],
+                   handshake_info['client_index'],
+                   handshake_info['server_index'])
+
+    @classmethod
+    def for_responder(cls, chain_key, sender_index, receiver_index):
+        # Builds the responder's session: the initiator's sending key is our receiving key
+        transport_keys = derive_transport_keys(chain_key)
+        return cls(transport_keys['T_client_receiving'],
+                   transport_keys['T_client_sending'],
+                   sender_index,
+                   receiver_index)
+
+    def _seal(self, counter, payload):
+        # Frames and encrypts one payload with the given counter
+        header_size = TRANSPORT_HEADER.size
+        nonce = TRANSPORT_NONCE.pack(counter)
+        if self._encrypt_into is not None:
+            packet = bytearray(header_size + len(payload) + AEAD_TAG_SIZE)
+            TRANSPORT_HEADER.pack_into(packet, 0, 4, self.receiver_index, counter)
+            self._encrypt_into(nonce, payload, b'', memoryview(packet)[header_size:])
+            return packet
+
+        encrypted_payload = self._send_cipher.encrypt(nonce, payload, b'')
+        packet = bytearray(header_size + len(encrypted_payload))
+        TRANSPORT_HEADER.pack_into(packet, 0, 4, self.receiver_index, counter)
+        packet[header_size:] = encrypted_payload
+        return packet
+
+    def reserve(self, count=1):
+        # Atomically claims `count` consecutive sending counters and returns the first one
+        # Only the increment is locked, so several threads can encrypt with their own counters in parallel
+        with self._counter_lock:
+            counter = self.sending_counter
+            self.sending_counter = counter + count
+        return counter
+
+    def encrypt(self, payload):
+        return self._seal(self.reserve(), payload)
+
+    def encrypt_many(self, payloads):
+        # Reserves a contiguous counter range once for the whole batch
+        first_counter = self.reserve(len(payloads))
+        return [self._seal(counter, payload) for counter, payload in enumerate(payloads, first_counter)]
+
+    def decrypt(self, input_data):
+        msg_type, receiver_index, counter, encrypted_data = unpack_transport_header(input_data)
+
+        # cheap replay check before paying for the decrypt
+        if not self.replay_window.check(counter):
+            raise ReplayError(f"Rejected replayed or stale transport counter {counter}")
+
+        decrypted_data = self._recv_cipher.decrypt(TRANSPORT_NONCE.pack(counter), encrypted_data, b'')
+
+        # only authenticated packets move the window
+        self.replay_window.update(counter)
+        if counter > self.receiving_counter:
+            self.receiving_counter = counter
+        return decrypted_data
+
+    def decrypt_many(self, datagrams):
+        # Packets that are replayed, truncated or fail authentication come back as None
+        decrypted = []
+        for input_data in datagrams:
+            try:
+                decrypted.append(self.decrypt(input_data))
+            except (ReplayError, InvalidTag, struct.error):
+                decrypted.append(None)
+        return decrypted
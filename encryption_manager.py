@@ -1,5 +1,72 @@
 import encryption
+import random
 import socket
+import threading
+import time
+from collections import namedtuple
+from cryptography.exceptions import InvalidTag
+
+# How many cookie replies the initial handshake accepts before giving up
+MAX_COOKIE_RETRIES = 3
+
+# Retransmission of handshake (and CONNECT) packets: the first wait is HANDSHAKE_TIMEOUT seconds,
+# doubling per attempt up to MAX_RETRANSMIT_TIMEOUT, with up to RETRANSMIT_JITTER of random extra wait
+HANDSHAKE_TIMEOUT = 1.0
+HANDSHAKE_ATTEMPTS = 5
+MAX_RETRANSMIT_TIMEOUT = 8.0
+RETRANSMIT_JITTER = 0.2
+
+class SessionExpired(RuntimeError):
+    # Raised by encrypt when the session has reached REJECT_AFTER_MESSAGES or REJECT_AFTER_TIME and no rekey
+    # has replaced it yet; a rekey is already under way when it is raised
+    pass
+
+class InvalidHandshakeReply(ValueError):
+    # Raised by complete_handshake for a handshake response or cookie reply that fails to parse or authenticate
+    # (corrupted or forged); the pending handshake is kept, so the real reply can still complete it
+    pass
+
+def backoff_delays(initial=HANDSHAKE_TIMEOUT, attempts=HANDSHAKE_ATTEMPTS, maximum=MAX_RETRANSMIT_TIMEOUT, jitter=RETRANSMIT_JITTER):
+    # Yields how long to wait for a reply on each attempt (jittered exponential backoff)
+    delay = initial
+    for _ in range(attempts):
+        yield delay * (1 + random.uniform(0, jitter))
+        delay = min(delay * 2, maximum)
+
+class SessionStats:
+    """
+    Per-manager counters for one chat session (across rekeys)
+    Plain attribute increments on the hot path; snapshot() copies them out as a dict
+    Times are cumulative seconds spent inside encrypt/decrypt and in completed handshakes
+    """
+
+    __slots__ = ('packets_sent', 'bytes_sent', 'packets_received', 'bytes_received',
+                 'aead_failures', 'replays_rejected', 'invalid_packets', 'handshakes', 'handshake_failures', 'handshake_time', 'last_handshake_time',
+                 'encrypt_time', 'decrypt_time')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def snapshot(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+# What EncryptionManager.decrypt made of a received datagram
+# payload is the plaintext for TRANSPORT_DATA and the reason for INVALID; control messages have already been
+# handled by the manager when they come back (payload None)
+DecryptResult = namedtuple('DecryptResult', ['kind', 'payload'])
+TRANSPORT_DATA = 'transport_data'
+HANDSHAKE_RESPONSE = 'handshake_response'
+COOKIE_REPLY = 'cookie_reply'
+INVALID = 'invalid'
+
+# Datagram sizes by message type, checked before any crypto work (transport data is at least a header and a tag)
+HANDSHAKE_RESPONSE_SIZE = 92
+COOKIE_REPLY_SIZE = 64
+MIN_TRANSPORT_SIZE = encryption.TRANSPORT_HEADER.size + encryption.AEAD_TAG_SIZE
+
+# Ephemeral keypairs are shared by every manager in the process, so a reconnect finds them pre-generated
+EPHEMERAL_KEY_POOL = encryption.EphemeralKeyPool()
 
 class EncryptionManager:
 
@@ -8,61 +75,411 @@ class EncryptionManager:
     #Calls the handshake initiation function
 
 
-    def __init__(self, server_public_key: bytes, client_private_key: bytes, sock: socket):
+    def __init__(self, server_public_key: bytes, client_private_key: bytes, sock: socket,
+                 rekey_after_messages: int = encryption.REKEY_AFTER_MESSAGES,
+                 rekey_after_time: float = encryption.REKEY_AFTER_TIME,
+                 rekey_grace: float = encryption.REJECT_AFTER_TIME - encryption.REKEY_AFTER_TIME,
+                 reject_after_messages: int = encryption.REJECT_AFTER_MESSAGES,
+                 reject_after_time: float = encryption.REJECT_AFTER_TIME,
+                 key_pool: encryption.EphemeralKeyPool = EPHEMERAL_KEY_POOL,
+                 establish: bool = True,
+                 handshake_timeout: float = HANDSHAKE_TIMEOUT,
+                 handshake_attempts: int = HANDSHAKE_ATTEMPTS):
         self.server_public_key = server_public_key
         self.client_private_key = client_private_key
         self.sock = sock
+        self.key_pool = key_pool
+        self.handshake_timeout = handshake_timeout
+        self.handshake_attempts = handshake_attempts
+
+        # Per-server handshake work is done once and reused on every (re)handshake
+        self.handshake_template = encryption.HandshakeTemplate(server_public_key, client_private_key)
+
+        # Rekeying policy: a new handshake is started after this many messages or seconds on one session,
+        # and the replaced session keeps decrypting for rekey_grace seconds afterwards
+        self.rekey_after_messages = rekey_after_messages
+        self.rekey_after_time = rekey_after_time
+        self.rekey_grace = rekey_grace
+        # Hard limits: past these a session is neither used for sending nor accepted on receive, rekey or not
+        self.reject_after_messages = reject_after_messages
+        self.reject_after_time = reject_after_time
 
         # Handshake and transport state
         self.handshake_info = None
-        self.transport_keys = None
-        self.establish_encryption()
+        self.session = None
+        self.previous_session = None
+        self.previous_session_expires = 0
+        self._rekey_deadline = 0
+        self._rekey_lock = threading.Lock()
+        self._pending_handshake = None
+        self._pending_handshake_started = float('-inf')
 
-    # Calls get_Initiation_Message and sends it to the server. 
-    # Proceeds to obtain further details via parsing a server response (parse_Server_Response)
+        # Last cookie received from the server (cookie reply, message type 3), used for MAC2 until it expires
+        self.cookie = None
+        self.cookie_received = 0
 
-    def establish_encryption(self):
-        handshake_info, init_msg, _ = encryption.get_Initiation_Message(
+        # Instrumentation (see stats_snapshot); _handshake_began times a handshake across its retransmissions
+        self.stats = SessionStats()
+        self._handshake_began = None
+        self._stats_stop = None
+
+        # establish=False leaves the handshake to the caller (begin_handshake/complete_handshake)
+        if establish:
+            self.establish_encryption()
+
+    # Builds a new initiation message, with MAC2 if we hold a fresh cookie
+
+    def _initiation(self):
+        private_key_ephemeral, public_key_ephemeral = self.key_pool.get()
+        return encryption.get_Initiation_Message(
                 self.server_public_key,
-                self.client_private_key
+                self.client_private_key,
+                client_private_key_ephemeral=private_key_ephemeral,
+                client_public_key_ephemeral=public_key_ephemeral,
+                template=self.handshake_template,
+                cookie=self._current_cookie()
         )
-        self.sock.send(init_msg)
-        resp, _ = self.sock.recvfrom(4096)
-
-        chain_key, handshake_info = encryption.parse_Server_Response(
-                response_message=resp,
-                handshake_info=handshake_info,
-                client_private_key_static=self.client_private_key,
-                testing=False
+
+    def _current_cookie(self):
+        if self.cookie is not None and time.monotonic() - self.cookie_received < encryption.COOKIE_LIFETIME:
+            return self.cookie
+        return None
+
+    # Stores the cookie from a cookie reply to the given handshake
+
+    def _consume_cookie(self, reply: bytes, handshake_info: dict):
+        receiver, cookie = encryption.consume_Cookie_Reply(
+                reply,
+                self.server_public_key,
+                handshake_info['mac1'],
+                cookie_key=self.handshake_template.cookie_key
         )
+        if receiver != handshake_info['client_index']:
+            raise ValueError("Cookie reply for an unknown handshake")
+        self.cookie = cookie
+        self.cookie_received = time.monotonic()
+
+    # Builds an initiation message and remembers the handshake it belongs to
+    # Used directly by non-blocking drivers (e.g. the asyncio client); establish_encryption wraps it for sockets
+
+    def begin_handshake(self) -> bytes:
+        handshake_info, init_msg, _ = self._initiation()
+        if self._handshake_began is None:
+            self._handshake_began = time.perf_counter()
+        self._pending_handshake = handshake_info
+        return init_msg
+
+    # Hooks for handshakes computed elsewhere (e.g. in a worker process, see session_manager.bulk_open_sessions):
+    # adopt the handshake_info of an initiation that was built outside this manager, then install the result
+
+    def adopt_initiation(self, handshake_info: dict):
+        if self._handshake_began is None:
+            self._handshake_began = time.perf_counter()
+        self._pending_handshake = handshake_info
+
+    def install_handshake(self, chain_key: bytes, handshake_info: dict):
+        self._pending_handshake = None
+        self._pending_handshake_started = float('-inf')
+        self._install_session(chain_key, handshake_info)
+
+    # Consumes the server's reply to the pending initiation
+    # Returns True once the new session is installed, or False for a cookie reply (resend begin_handshake())
+    # Raises InvalidHandshakeReply for a reply that does not parse or authenticate; the handshake stays pending
+
+    def complete_handshake(self, resp: bytes) -> bool:
+        handshake_info = self._pending_handshake
+        if handshake_info is None:
+            raise ValueError("No handshake in progress")
+
+        try:
+            if resp[0] == 3:
+                self._consume_cookie(resp, handshake_info)
+                return False
+            if resp[0] != 2 or resp[8:12] != handshake_info['client_index']:
+                raise ValueError("Unexpected handshake response")
+
+            chain_key, handshake_info = encryption.parse_Server_Response(
+                    response_message=resp,
+                    handshake_info=handshake_info,
+                    client_private_key_static=self.client_private_key,
+                    testing=False
+            )
+        except Exception as e:
+            self.stats.handshake_failures += 1
+            raise InvalidHandshakeReply(f"Invalid handshake reply: {e!r}") from e
+
+        # only a reply that authenticated ends the pending handshake
+        self._pending_handshake = None
+        self._pending_handshake_started = float('-inf')
+        self._install_session(chain_key, handshake_info)
+        return True
+
+    # Calls get_Initiation_Message and sends it to the server.
+    # Proceeds to obtain further details via parsing a server response (parse_Server_Response)
+    # A lost packet costs one retransmission timeout: a fresh initiation is sent with jittered exponential backoff,
+    # and TimeoutError is raised after handshake_attempts attempts
+    # A server under load answers with a cookie reply instead; the initiation is then resent straight away with MAC2
+
+    def establish_encryption(self):
+        cookie_replies = 0
+        previous_timeout = self.sock.gettimeout()
+        try:
+            for delay in backoff_delays(self.handshake_timeout, self.handshake_attempts):
+                self.sock.send(self.begin_handshake())
+                deadline = time.monotonic() + delay
+                while True:
+                    resp = self._await_handshake_reply(deadline - time.monotonic())
+                    if resp is None:
+                        break
+                    try:
+                        if self.complete_handshake(resp):
+                            print("Encryption established")
+                            return
+                    except InvalidHandshakeReply:
+                        # corrupted or forged: keep waiting for the real reply until this attempt times out
+                        continue
+                    cookie_replies += 1
+                    if cookie_replies > MAX_COOKIE_RETRIES:
+                        raise RuntimeError("Handshake failed: server kept answering with cookie replies")
+                    self.sock.send(self.begin_handshake())
+                    deadline = time.monotonic() + delay
+        finally:
+            self.sock.settimeout(previous_timeout)
 
+        raise TimeoutError(f"Handshake failed: no response from server after {self.handshake_attempts} attempts")
+
+    # Waits up to `timeout` seconds for the reply to the pending initiation
+    # Stray datagrams (e.g. replies to an earlier, retransmitted initiation) are skipped; returns None on timeout
+
+    def _await_handshake_reply(self, timeout):
+        client_index = self._pending_handshake['client_index']
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                resp, _ = self.sock.recvfrom(4096)
+            except socket.timeout:
+                return None
+            if resp[0] == 2 and resp[8:12] == client_index:
+                return resp
+            if resp[0] == 3 and resp[4:8] == client_index:
+                return resp
+
+    # Swaps in the session from a completed handshake
+    # The old session is kept for decrypting in-flight packets until the grace period runs out
+
+    def _install_session(self, chain_key, handshake_info):
+        session = encryption.TransportSession.from_handshake(chain_key, handshake_info)
+
+        stats = self.stats
+        stats.handshakes += 1
+        if self._handshake_began is not None:
+            stats.last_handshake_time = time.perf_counter() - self._handshake_began
+            stats.handshake_time += stats.last_handshake_time
+            self._handshake_began = None
+
+        if self.session is not None:
+            self.previous_session = self.session
+            self.previous_session_expires = min(time.monotonic() + self.rekey_grace,
+                                                self.session.created + self.reject_after_time)
         self.handshake_info = handshake_info
-        self.transport_keys = encryption.derive_transport_keys(chain_key)
-        print("Encryption established")
+        self._rekey_deadline = session.created + self.rekey_after_time
+        self.session = session
+
+    # Starts a rekey handshake in the background unless one is already in flight
+    # The current session keeps encrypting until the response arrives (see decrypt)
+
+    def _start_rekey(self):
+        with self._rekey_lock:
+            # a handshake that got no response within REKEY_TIMEOUT is abandoned and retried
+            now = time.monotonic()
+            if now - self._pending_handshake_started < encryption.REKEY_TIMEOUT:
+                return
+            self._pending_handshake = None
+            self._pending_handshake_started = now
+        threading.Thread(target=self._send_rekey_initiation, daemon=True).start()
+
+    def _send_rekey_initiation(self):
+        try:
+            self.sock.send(self.begin_handshake())
+        except Exception as e:
+            print(f"Rekey initiation failed: {e}")
+
+    # Handles the server's reply to a background rekey
+    # A cookie reply means the server was too busy: the initiation is resent straight away with MAC2
 
-    # Encrypts given data to send across the network 
+    def _rekey_reply(self, resp: bytes):
+        if not self.complete_handshake(resp):
+            self._pending_handshake_started = float('-inf')
+            self._start_rekey()
+
+    # Returns the current session if it may send `count` more messages, else starts a rekey and raises SessionExpired
+
+    def _sending_session(self, count):
+        session = self.session
+        if session is None:
+            raise RuntimeError("Handshake not completed")
+        if session.sending_counter + count > self.reject_after_messages:
+            self._start_rekey()
+            raise SessionExpired("Session reached REJECT_AFTER_MESSAGES, waiting for rekey")
+        if time.monotonic() - session.created >= self.reject_after_time:
+            self._start_rekey()
+            raise SessionExpired("Session reached REJECT_AFTER_TIME, waiting for rekey")
+        return session
+
+    # Encrypts given data to send across the network
     # Abstracts encryption procedure
+    # Safe to call from several threads: each call claims its own nonce from the session before encrypting
+    # Raises SessionExpired once the session is past the reject limits and no rekey has succeeded
 
     def encrypt(self, payload: bytes) -> bytes:
-        if self.transport_keys is None or self.handshake_info is None:
-            raise RuntimeError("Handshake not completed") 
+        session = self._sending_session(1)
 
-        self.transport_keys, encrypted_msg = encryption.construct_transport_message(
-            transport_keys=self.transport_keys,
-            handshake_info=self.handshake_info,
-            payload=payload
-        )
+        started = time.perf_counter()
+        encrypted_msg = session.encrypt(payload)
+        stats = self.stats
+        stats.encrypt_time += time.perf_counter() - started
+        stats.packets_sent += 1
+        stats.bytes_sent += len(encrypted_msg)
+
+        if session.sending_counter >= self.rekey_after_messages or time.monotonic() >= self._rekey_deadline:
+            self._start_rekey()
         return encrypted_msg
 
+    # Encrypts a batch of payloads in one call, using a contiguous range of counters
+    # Returns the packets in the same order as the payloads
+
+    def encrypt_many(self, payloads: list) -> list:
+        session = self._sending_session(len(payloads))
+
+        started = time.perf_counter()
+        encrypted_msgs = session.encrypt_many(payloads)
+        stats = self.stats
+        stats.encrypt_time += time.perf_counter() - started
+        stats.packets_sent += len(encrypted_msgs)
+        stats.bytes_sent += sum(map(len, encrypted_msgs))
+
+        if session.sending_counter >= self.rekey_after_messages or time.monotonic() >= self._rekey_deadline:
+            self._start_rekey()
+        return encrypted_msgs
+
+    # Picks the session a transport packet belongs to (current, or the previous one during the grace period)
+    # Returns None if the receiver index is not ours, or its session is older than reject_after_time
+
+    def _session_for(self, encrypted_msg):
+        receiver_index = encrypted_msg[4:8]
+        session = self.session
+        if receiver_index == session.sender_index:
+            if time.monotonic() - session.created >= self.reject_after_time:
+                self._start_rekey()
+                return None
+            return session
+        previous = self.previous_session
+        if previous is not None and receiver_index == previous.sender_index:
+            if time.monotonic() < self.previous_session_expires:
+                return previous
+            self.previous_session = None
+        return None
+
     # Decrypts given data recevied from the network
     # Abstracts decryption procedure
+    # The message type, length and receiver index are checked first, so junk is rejected without any crypto work
+    # Returns a DecryptResult: TRANSPORT_DATA with the plaintext, HANDSHAKE_RESPONSE/COOKIE_REPLY once a background
+    # rekey reply has been consumed, or INVALID with the reason the datagram was dropped
 
-    def decrypt(self, encrypted_msg: bytes) -> bytes:
-        if self.transport_keys is None:
+    def decrypt(self, encrypted_msg: bytes) -> DecryptResult:
+        if self.session is None:
             raise RuntimeError("Transport keys not set.")
 
-        plaintext, self.transport_keys = encryption.consume_transport_message(
-            encrypted_msg,
-            self.transport_keys
-        )
-        return plaintext
+        length = len(encrypted_msg)
+        msg_type = encrypted_msg[0] if length else 0
+        stats = self.stats
+
+        if msg_type == 4 and length >= MIN_TRANSPORT_SIZE:
+            session = self._session_for(encrypted_msg)
+            if session is None:
+                stats.invalid_packets += 1
+                return DecryptResult(INVALID, "unknown receiver index or expired session")
+
+            stats.packets_received += 1
+            stats.bytes_received += length
+            started = time.perf_counter()
+            try:
+                return DecryptResult(TRANSPORT_DATA, session.decrypt(encrypted_msg))
+            except encryption.ReplayError:
+                stats.replays_rejected += 1
+                return DecryptResult(INVALID, "replayed counter")
+            except InvalidTag:
+                stats.aead_failures += 1
+                return DecryptResult(INVALID, "authentication failed")
+            finally:
+                stats.decrypt_time += time.perf_counter() - started
+
+        if msg_type == 2 and length == HANDSHAKE_RESPONSE_SIZE:
+            return self._control_message(HANDSHAKE_RESPONSE, encrypted_msg, encrypted_msg[8:12])
+        if msg_type == 3 and length == COOKIE_REPLY_SIZE:
+            return self._control_message(COOKIE_REPLY, encrypted_msg, encrypted_msg[4:8])
+
+        stats.invalid_packets += 1
+        return DecryptResult(INVALID, "malformed datagram")
+
+    # Hands a handshake response or cookie reply to the pending rekey, if it is addressed to it
+
+    def _control_message(self, kind, encrypted_msg, receiver_index):
+        pending = self._pending_handshake
+        if pending is None or receiver_index != pending['client_index']:
+            self.stats.invalid_packets += 1
+            return DecryptResult(INVALID, "no matching handshake")
+        try:
+            self._rekey_reply(encrypted_msg)
+        except Exception:
+            self.stats.invalid_packets += 1
+            return DecryptResult(INVALID, "handshake reply failed")
+        return DecryptResult(kind, None)
+
+    # Decrypts a burst of received datagrams in one call
+    # Returns the plaintexts in order; control messages and packets that are dropped come back as None
+
+    def decrypt_many(self, encrypted_msgs: list) -> list:
+        return [result.payload if result.kind == TRANSPORT_DATA else None
+                for result in map(self.decrypt, encrypted_msgs)]
+
+    # Stats for this session: the SessionStats counters plus the live transport state
+    # (counters, indices and key age of the current session)
+
+    def stats_snapshot(self) -> dict:
+        snapshot = self.stats.snapshot()
+        session = self.session
+        if session is not None:
+            snapshot.update({
+                'sender_index': session.sender_index.hex(),
+                'receiver_index': session.receiver_index.hex(),
+                'sending_counter': session.sending_counter,
+                'receiving_counter': session.receiving_counter,
+                'session_age': time.monotonic() - session.created,
+            })
+        snapshot['rekey_pending'] = self._pending_handshake is not None
+        return snapshot
+
+    # Calls sink(stats_snapshot()) every `interval` seconds from a background thread until stop_stats_dump()
+
+    def start_stats_dump(self, interval: float, sink=print):
+        self.stop_stats_dump()
+        stop = self._stats_stop = threading.Event()
+
+        def dump():
+            while not stop.wait(interval):
+                try:
+                    sink(self.stats_snapshot())
+                except Exception as e:
+                    print(f"Stats dump failed: {e}")
+
+        threading.Thread(target=dump, daemon=True).start()
+
+    def stop_stats_dump(self):
+        if self._stats_stop is not None:
+            self._stats_stop.set()
+            self._stats_stop = None
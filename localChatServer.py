@@ -0,0 +1,399 @@
+import argparse
+import base64
+import msgpack
+import nacl.public
+import secrets
+import socket
+import threading
+import time
+import encryption
+
+# Local stand-in for the chat server, built on the responder side of encryption.py
+# Speaks the same handshake, transport encryption and msgpack chat protocol (request types 1-14, response types 20-37),
+# so the clients can be run, tested and benchmarked offline:
+#
+#   python localChatServer.py --port 51820
+#
+# One listener thread serves every client; all chat state lives in memory and is lost on close()
+
+DEFAULT_ADDRESS = ('127.0.0.1', 51820)
+
+# Page sizes of CHANNEL_LIST and USER_LIST (as paged by the GUI)
+CHANNEL_PAGE_SIZE = 10
+USER_PAGE_SIZE = 20
+
+# Transport sessions kept per client key besides those carrying a live chat session or awaiting their first CONNECT:
+# transports replaced by a rekey (for in-flight packets), disconnected ones, and ones that never connected;
+# the oldest of these are evicted first
+SESSIONS_PER_PEER = 2
+
+# Seconds a new transport is kept for its first CONNECT (longer than the clients' CONNECT retransmissions),
+# so clients that share a static key and handshake at the same time do not evict each other
+CONNECT_WAIT = 30
+
+# Large receive buffer so bursts from load generators queue up instead of being dropped
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+class _Peer:
+    # One transport session with a client, created by a handshake
+    # connect_handle is the request_handle of the CONNECT that created its chat session, to recognise retransmissions
+    __slots__ = ('transport', 'address', 'static_key', 'client', 'connect_handle', 'created')
+
+    def __init__(self, transport, address, static_key):
+        self.transport = transport
+        self.address = address
+        self.static_key = static_key
+        self.client = None
+        self.connect_handle = None
+        self.created = time.monotonic()
+
+class _Client:
+    # One chat session (from CONNECT to DISCONNECT)
+    __slots__ = ('session', 'username', 'peer', 'channels')
+
+    def __init__(self, session, username, peer):
+        self.session = session
+        self.username = username
+        self.peer = peer
+        self.channels = set()
+
+class _Channel:
+    __slots__ = ('name', 'description', 'members')
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.members = set()
+
+class LocalChatServer:
+
+    def __init__(self, address=DEFAULT_ADDRESS, private_key: bytes = None, welcome_message="Welcome to the local chat server"):
+        if private_key is None:
+            private_key, public_key = encryption.DH_Generate()
+        else:
+            public_key = nacl.public.PrivateKey(private_key).public_key.encode()
+        self.private_key = private_key
+        self.public_key = public_key
+        self.welcome_message = welcome_message
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        self.sock.bind(address)
+        self.address = self.sock.getsockname()
+
+        # Transport sessions by our receiver index, and the live indices (oldest first) per client static key
+        self._peers_by_index = {}
+        self._indices_by_key = {}
+        # Latest handshake timestamp per client static key, to drop replayed initiations
+        self._timestamps = {}
+
+        self.clients = {}    # session id -> _Client
+        self.usernames = {}  # username -> _Client
+        self.channels = {}   # channel name -> _Channel
+
+        self._handlers = {
+            1: self._connect,
+            2: self._disconnect,
+            3: self._ping,
+            4: self._channel_create,
+            5: self._channel_list,
+            6: self._channel_info,
+            7: self._channel_join,
+            8: self._channel_leave,
+            9: self._channel_message,
+            10: self._whois,
+            11: self._whoami,
+            12: self._user_message,
+            13: self._set_username,
+            14: self._user_list,
+        }
+
+        self.running = False
+        self.listener_thread = None
+
+    # Serves in a background thread; returns self so `LocalChatServer().start()` can be passed around
+    def start(self):
+        self.running = True
+        self.listener_thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.listener_thread.start()
+        return self
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            try:
+                data, address = self.sock.recvfrom(4096)
+            except OSError:
+                break
+            try:
+                if data[0] == 1:
+                    self._handshake(data, address)
+                elif data[0] == 4:
+                    self._transport(data, address)
+            except Exception:
+                # malformed, replayed or unauthenticated datagrams are dropped, as a WireGuard responder would
+                continue
+
+    # Tells every client the server is going away, then closes the socket
+    def close(self, message="Server shutting down"):
+        for client in list(self.clients.values()):
+            try:
+                self._send(client.peer, {'response_type': 37, 'message': message})
+            except OSError:
+                pass
+        self.running = False
+        self.sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Handshake - Sections 5.4.2 and 5.4.3 (responder side)
+
+    def _handshake(self, data, address):
+        responder_info = encryption.consume_Initiation_Message(data, self.private_key, self.public_key)
+
+        static_key = responder_info['client_public_key_static']
+        if responder_info['timestamp'] <= self._timestamps.get(static_key, b''):
+            return
+        self._timestamps[static_key] = responder_info['timestamp']
+
+        chain_key, sender_index, response = encryption.get_Server_Response(responder_info)
+        while sender_index in self._peers_by_index:
+            chain_key, sender_index, response = encryption.get_Server_Response(responder_info)
+
+        transport = encryption.TransportSession.for_responder(chain_key, sender_index, responder_info['client_index'])
+        peer = _Peer(transport, address, static_key)
+
+        # Several clients may share a static key, so a handshake is not tied to a chat session here: after a rekey
+        # the client's next request names its session, and _transport moves the session onto the new transport
+        indices = self._indices_by_key.setdefault(static_key, [])
+        indices.append(sender_index)
+        self._peers_by_index[sender_index] = peer
+        now = time.monotonic()
+        spare = [index for index in indices if not self._in_use(self._peers_by_index[index], now)]
+        for index in spare[:len(spare) - SESSIONS_PER_PEER]:
+            indices.remove(index)
+            del self._peers_by_index[index]
+
+        self.sock.sendto(response, address)
+
+    # True if the transport is the one a live chat session currently uses, or is new and may still get its CONNECT
+    # (such transports are never evicted)
+    def _in_use(self, peer, now):
+        client = peer.client
+        if client is not None and client.peer is peer and client.session in self.clients:
+            return True
+        return client is None and peer.connect_handle is None and now - peer.created < CONNECT_WAIT
+
+    # Transport data - Section 5.4.6
+
+    def _transport(self, data, address):
+        peer = self._peers_by_index.get(bytes(data[4:8]))
+        if peer is None:
+            return
+        request = msgpack.unpackb(peer.transport.decrypt(data), raw=False)
+        peer.address = address
+
+        handler = self._handlers.get(request.get('request_type'))
+        if handler is None:
+            self._error(peer, request, "Unknown request type")
+            return
+
+        if request.get('request_type') != 1:
+            client = self.clients.get(request.get('session'))
+            if client is None or client.peer.static_key != peer.static_key:
+                self._error(peer, request, "Invalid session")
+                return
+            client.peer = peer
+            peer.client = client
+
+        handler(peer, request)
+
+    def _send(self, peer, msg):
+        self.sock.sendto(peer.transport.encrypt(msgpack.packb(msg)), peer.address)
+
+    def _reply(self, peer, request, msg):
+        msg['request_handle'] = request.get('request_handle')
+        self._send(peer, msg)
+
+    def _error(self, peer, request, error):
+        self._reply(peer, request, {'response_type': 20, 'error': error})
+
+    # Chat requests - each handler answers the requesting peer (and notifies others where the protocol says so)
+
+    def _connect(self, peer, request):
+        # A retransmitted CONNECT (same request_handle on the same transport) gets the same session back;
+        # any other CONNECT starts a new chat session
+        client = peer.client
+        if (client is None or client.session not in self.clients
+                or peer.connect_handle is None or peer.connect_handle != request.get('request_handle')):
+            session = secrets.randbits(32)
+            while session in self.clients:
+                session = secrets.randbits(32)
+            username = f"guest{session % 100000:05d}"
+            while username in self.usernames:
+                username += "_"
+            client = _Client(session, username, peer)
+            self.clients[session] = client
+            self.usernames[username] = client
+            peer.client = client
+            peer.connect_handle = request.get('request_handle')
+        self._reply(peer, request, {
+            'response_type': 22,
+            'session': client.session,
+            'username': client.username,
+            'message': self.welcome_message
+        })
+
+    def _disconnect(self, peer, request):
+        client = peer.client
+        for name in client.channels:
+            self.channels[name].members.discard(client)
+        client.channels.clear()
+        self.clients.pop(client.session, None)
+        self.usernames.pop(client.username, None)
+        peer.client = None
+        self._reply(peer, request, {'response_type': 23, 'message': "Goodbye"})
+
+    def _ping(self, peer, request):
+        self._reply(peer, request, {'response_type': 24})
+
+    def _channel_create(self, peer, request):
+        name = request.get('channel')
+        if not name or name in self.channels:
+            self._error(peer, request, f"Could not create channel '{name}': already exists")
+            return
+        channel = self.channels[name] = _Channel(name, request.get('description', ''))
+        channel.members.add(peer.client)
+        peer.client.channels.add(name)
+        self._reply(peer, request, {'response_type': 25, 'channel': name, 'description': channel.description})
+
+    def _channel_list(self, peer, request):
+        offset = max(0, int(request.get('offset', 0)))
+        names = sorted(self.channels)[offset:offset + CHANNEL_PAGE_SIZE]
+        self._reply(peer, request, {'response_type': 26, 'offset': offset, 'channels': names})
+
+    def _channel_info(self, peer, request):
+        channel = self.channels.get(request.get('channel'))
+        if channel is None:
+            self._error(peer, request, f"Channel '{request.get('channel')}' not found")
+            return
+        self._reply(peer, request, {
+            'response_type': 27,
+            'channel': channel.name,
+            'description': channel.description,
+            'members': sorted(member.username for member in channel.members)
+        })
+
+    def _channel_join(self, peer, request):
+        channel = self.channels.get(request.get('channel'))
+        if channel is None:
+            self._error(peer, request, f"Could not join channel '{request.get('channel')}': channel not found")
+            return
+        channel.members.add(peer.client)
+        peer.client.channels.add(channel.name)
+        self._reply(peer, request, {'response_type': 28, 'channel': channel.name})
+
+    def _channel_leave(self, peer, request):
+        channel = self.channels.get(request.get('channel'))
+        if channel is None or peer.client not in channel.members:
+            self._error(peer, request, f"Could not leave channel '{request.get('channel')}': not a member")
+            return
+        channel.members.discard(peer.client)
+        peer.client.channels.discard(channel.name)
+        self._reply(peer, request, {'response_type': 29, 'channel': channel.name})
+
+    def _channel_message(self, peer, request):
+        channel = self.channels.get(request.get('channel'))
+        if channel is None or peer.client not in channel.members:
+            self._error(peer, request, f"Could not send to channel '{request.get('channel')}': not a member")
+            return
+        # Every member gets the message, the sender included (its copy carries the request handle)
+        msg = {
+            'response_type': 30,
+            'channel': channel.name,
+            'username': peer.client.username,
+            'message': request.get('message', '')
+        }
+        for member in channel.members:
+            if member is not peer.client:
+                self._send(member.peer, msg)
+        self._reply(peer, request, msg)
+
+    def _whois(self, peer, request):
+        client = self.usernames.get(request.get('username'))
+        if client is None:
+            self._error(peer, request, f"User '{request.get('username')}' not found")
+            return
+        self._reply(peer, request, {
+            'response_type': 31,
+            'username': client.username,
+            'status': 'online',
+            'transport': 'wireguard',
+            'wireguard_public_key': base64.b64encode(client.peer.static_key).decode(),
+            'channels': sorted(client.channels)
+        })
+
+    def _whoami(self, peer, request):
+        self._reply(peer, request, {'response_type': 32, 'username': peer.client.username})
+
+    def _user_message(self, peer, request):
+        recipient = self.usernames.get(request.get('to_username'))
+        if recipient is None:
+            self._error(peer, request, f"User '{request.get('to_username')}' not found")
+            return
+        msg = {
+            'response_type': 33,
+            'from_username': peer.client.username,
+            'to_username': recipient.username,
+            'message': request.get('message', '')
+        }
+        if recipient is not peer.client:
+            self._send(recipient.peer, msg)
+        self._reply(peer, request, msg)
+
+    def _set_username(self, peer, request):
+        client = peer.client
+        new = request.get('username')
+        if not new or (new in self.usernames and self.usernames[new] is not client):
+            self._error(peer, request, f"Username '{new}' is already taken")
+            return
+        old = client.username
+        del self.usernames[old]
+        client.username = new
+        self.usernames[new] = client
+        self._reply(peer, request, {'response_type': 34, 'old_username': old, 'new_username': new})
+
+    def _user_list(self, peer, request):
+        offset = max(0, int(request.get('offset', 0)))
+        names = sorted(self.usernames)[offset:offset + USER_PAGE_SIZE]
+        self._reply(peer, request, {'response_type': 35, 'offset': offset, 'users': names})
+
+    # Broadcasts a SERVER_MESSAGE (response type 36) to every connected client
+    def server_message(self, message):
+        for client in list(self.clients.values()):
+            self._send(client.peer, {'response_type': 36, 'message': message})
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stand-in chat server")
+    parser.add_argument("--host", default=DEFAULT_ADDRESS[0])
+    parser.add_argument("--port", type=int, default=DEFAULT_ADDRESS[1])
+    parser.add_argument("--private-key", help="base64 server private key (a new one is generated if omitted)")
+    args = parser.parse_args()
+
+    private_key = base64.b64decode(args.private_key) if args.private_key else None
+    server = LocalChatServer((args.host, args.port), private_key)
+    print(f"Listening on {server.address[0]}:{server.address[1]}")
+    print(f"Server public key: {base64.b64encode(server.public_key).decode()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == "__main__":
+    main()
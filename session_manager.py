@@ -0,0 +1,342 @@
+import msgpack
+import os
+import queue
+import socket
+import threading
+import time
+from itertools import repeat
+import encryption
+import encryption_manager
+from chatClientFunctions import build_request, new_request_handle, pack_request, request_packet
+
+# Runs many WireGuard sessions (e.g. a fleet of bot accounts or a load generator) over one UDP socket
+# Incoming datagrams are routed to their session by receiver index, so there is one socket and one listener thread
+# no matter how many sessions are open
+
+# Worker-process side of bulk_open_sessions: the Curve25519 DH and BLAKE2s KDF chains of many handshakes
+# run here, in parallel, and only picklable handshake state (bytes in dicts) travels back to the parent
+
+def _build_initiations(server_public_key, client_private_keys):
+    results = []
+    for client_private_key in client_private_keys:
+        handshake_info, init_msg, _ = encryption.get_Initiation_Message(server_public_key, client_private_key)
+        results.append((handshake_info, init_msg))
+    return results
+
+def _process_responses(work):
+    # work is a list of (response, handshake_info, client_private_key); failed handshakes come back as None
+    results = []
+    for response, handshake_info, client_private_key in work:
+        try:
+            results.append(encryption.parse_Server_Response(response, handshake_info, client_private_key))
+        except Exception:
+            results.append(None)
+    return results
+
+def _chunks(items, count):
+    size = max(1, -(-len(items) // count))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+class _AddressedSender:
+    # Gives an EncryptionManager a connected-socket style send() on the shared, unconnected socket
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+
+    def send(self, data):
+        self.sock.sendto(data, self.address)
+
+class _DemuxedEncryptionManager(encryption_manager.EncryptionManager):
+    # Registers the sender index of every initiation (first handshake and rekeys) with the SessionManager,
+    # so the reply and later transport packets are routed back to this session
+
+    def __init__(self, managed_session, *args, **kwargs):
+        self.managed_session = managed_session
+        super().__init__(*args, establish=False, **kwargs)
+
+    def begin_handshake(self) -> bytes:
+        init_msg = super().begin_handshake()
+        self.managed_session.session_manager._register(self._pending_handshake['client_index'], self.managed_session)
+        return init_msg
+
+class ManagedSession:
+    """
+    One chat session inside a SessionManager
+    Decoded server messages are passed to on_message if given, otherwise queued for receive()
+    """
+
+    def __init__(self, session_manager, server_address, server_public_key, client_private_key, on_message=None):
+        self.session_manager = session_manager
+        self.server_address = server_address
+        self.on_message = on_message
+        self.manager = _DemuxedEncryptionManager(
+            self, server_public_key, client_private_key, _AddressedSender(session_manager.sock, server_address)
+        )
+        self.session = None
+        self.welcome_message = None
+        self.indices = set()
+
+        self._inbox = queue.Queue()
+        self._established = threading.Event()
+        self._connected = threading.Event()
+        self._cookie_replies = 0
+
+        # Set by bulk_open_sessions: handshake responses are stored for a worker process instead of parsed here,
+        # as (response, the handshake_info of the initiation it answers)
+        self._defer_handshake = False
+        self._handshake_response = None
+        self._responded = threading.Event()
+
+    def _send_initiation(self):
+        self.manager.sock.send(self.manager.begin_handshake())
+
+    # Called from the SessionManager's listener thread for every datagram routed to this session
+    def _datagram_received(self, data):
+        if not self._established.is_set():
+            if data[0] == 2 and self._defer_handshake:
+                # read once, so the response is kept with the handshake it matched even if a retransmission
+                # replaces _pending_handshake meanwhile
+                pending_handshake = self.manager._pending_handshake
+                if data[8:12] == pending_handshake['client_index']:
+                    self._handshake_response = (data, pending_handshake)
+                    self._responded.set()
+            elif data[0] == 2 or data[0] == 3:
+                try:
+                    established = self.manager.complete_handshake(data)
+                except encryption_manager.InvalidHandshakeReply:
+                    # dropped; the handshake stays pending for the real reply
+                    return
+                if established:
+                    self._established.set()
+                elif self._cookie_replies < encryption_manager.MAX_COOKIE_RETRIES:
+                    # cookie reply: resend straight away with MAC2
+                    self._cookie_replies += 1
+                    self._send_initiation()
+            return
+
+        result = self.manager.decrypt(data)
+        if result.kind != encryption_manager.TRANSPORT_DATA:
+            return
+        msg = msgpack.unpackb(result.payload, raw=False)
+
+        # The first message after CONNECT carries our session id
+        if self.session is None and isinstance(msg, dict) and 'session' in msg:
+            self.welcome_message = msg
+            self.session = msg['session']
+            self._connected.set()
+            return
+
+        if self.on_message is not None:
+            self.on_message(self, msg)
+        else:
+            self._inbox.put(msg)
+
+    # Sends the CONNECT request, retransmitting with backoff until the server answers with a session id
+    def connect(self, timeout=encryption_manager.HANDSHAKE_TIMEOUT, attempts=encryption_manager.HANDSHAKE_ATTEMPTS):
+        self.session_manager.connect_sessions([self], timeout, attempts)
+        return self.welcome_message
+
+    def send(self, packet: dict):
+        self.manager.sock.send(self.manager.encrypt(pack_request(packet)))
+
+    def send_many(self, packets: list):
+        for encrypted_packet in self.manager.encrypt_many([pack_request(packet) for packet in packets]):
+            self.manager.sock.send(encrypted_packet)
+
+    # Same commands as ChatClient.request (e.g. "/CHANNEL_JOIN general"); returns the packet sent (or None)
+    def request(self, userInput):
+        packet = build_request(self.session, userInput)
+        if packet:
+            self.send(packet)
+        return packet
+
+    # Structured form of request(), e.g. send_request("/CHANNEL_JOIN", channel="general"); returns the packet sent
+    def send_request(self, request_type, **arguments):
+        packet = request_packet(self.session, request_type, **arguments)
+        self.send(packet)
+        return packet
+
+    # Next decoded message from the server (only used when no on_message callback is set)
+    def receive(self, timeout=None):
+        try:
+            return self._inbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    # Sends /DISCONNECT and stops routing packets to this session
+    def close(self):
+        if self.session is not None:
+            self.request("/DISCONNECT")
+        self.session_manager._unregister(self)
+
+class SessionManager:
+
+    def __init__(self, bind_address=('0.0.0.0', 0)):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(bind_address)
+
+        self._sessions_by_index = {}
+        self._lock = threading.Lock()
+        self.running = True
+        self.listener_thread = threading.Thread(target=self._listen, daemon=True)
+        self.listener_thread.start()
+
+    def _register(self, index, managed_session):
+        with self._lock:
+            self._sessions_by_index[index] = managed_session
+            managed_session.indices.add(index)
+
+            # Forget indices the session no longer answers to (anything but the current, previous and pending handshake)
+            manager = managed_session.manager
+            live = {index}
+            for session in (manager.session, manager.previous_session):
+                if session is not None:
+                    live.add(session.sender_index)
+            for stale in managed_session.indices - live:
+                self._sessions_by_index.pop(stale, None)
+            managed_session.indices &= live
+
+    def _unregister(self, managed_session):
+        with self._lock:
+            for index in managed_session.indices:
+                self._sessions_by_index.pop(index, None)
+            managed_session.indices.clear()
+
+    # Listener thread: routes every datagram to its session by receiver index
+    # (bytes 4:8 for transport packets and cookie replies, 8:12 for handshake responses)
+    def _listen(self):
+        while self.running:
+            try:
+                data, _ = self.sock.recvfrom(4096)
+            except OSError:
+                break
+            if len(data) < 12:
+                continue
+            index = data[8:12] if data[0] == 2 else data[4:8]
+            managed_session = self._sessions_by_index.get(index)
+            if managed_session is None:
+                continue
+            try:
+                managed_session._datagram_received(data)
+            except Exception as e:
+                print(f"Session error: {e}")
+
+    # Handshakes with the server for every private key at once, retransmitting those that got no reply
+    # Returns the established sessions (in key order); raises TimeoutError if any handshake never completes
+    def open_sessions(self, server_address, server_public_key, client_private_keys, on_message=None, connect=True,
+                      timeout=encryption_manager.HANDSHAKE_TIMEOUT, attempts=encryption_manager.HANDSHAKE_ATTEMPTS):
+        sessions = [ManagedSession(self, server_address, server_public_key, key, on_message) for key in client_private_keys]
+
+        pending = sessions
+        for delay in encryption_manager.backoff_delays(timeout, attempts):
+            for managed_session in pending:
+                managed_session._send_initiation()
+            deadline = time.monotonic() + delay
+            for managed_session in pending:
+                managed_session._established.wait(max(0, deadline - time.monotonic()))
+            pending = [s for s in pending if not s._established.is_set()]
+            if not pending:
+                break
+        else:
+            for managed_session in sessions:
+                self._unregister(managed_session)
+            raise TimeoutError(f"Handshake failed: {len(pending)} of {len(sessions)} sessions got no response after {attempts} attempts")
+
+        if connect:
+            self.connect_sessions(sessions, timeout, attempts)
+        return sessions
+
+    # Sends CONNECT for every session at once, retransmitting to those that have no session id yet
+    def connect_sessions(self, sessions, timeout=encryption_manager.HANDSHAKE_TIMEOUT, attempts=encryption_manager.HANDSHAKE_ATTEMPTS):
+        packet = {'request_type': 1, 'request_handle': new_request_handle()}
+        pending = sessions
+        for delay in encryption_manager.backoff_delays(timeout, attempts):
+            for managed_session in pending:
+                managed_session.send(packet)
+            deadline = time.monotonic() + delay
+            for managed_session in pending:
+                managed_session._connected.wait(max(0, deadline - time.monotonic()))
+            pending = [s for s in pending if not s._connected.is_set()]
+            if not pending:
+                return
+        raise TimeoutError(f"CONNECT failed: {len(pending)} of {len(sessions)} sessions got no response after {attempts} attempts")
+
+    # Like open_sessions, but the handshake crypto (initiations and response processing) runs in a process pool,
+    # so bringing up thousands of sessions is not bound to one GIL-bound core
+    # Retransmitted initiations (after a lost packet) and cookie replies are handled in this process
+    def bulk_open_sessions(self, server_address, server_public_key, client_private_keys, on_message=None, connect=True,
+                           max_workers=None, timeout=encryption_manager.HANDSHAKE_TIMEOUT,
+                           attempts=encryption_manager.HANDSHAKE_ATTEMPTS):
+        # imported here: multiprocessing is only needed by bulk handshakes, not by every session manager
+        from concurrent.futures import ProcessPoolExecutor
+
+        sessions = [ManagedSession(self, server_address, server_public_key, key, on_message) for key in client_private_keys]
+        for managed_session in sessions:
+            managed_session._defer_handshake = True
+
+        with ProcessPoolExecutor(max_workers) as executor:
+            chunk_count = (max_workers or os.cpu_count() or 1) * 4
+
+            # Build all initiations in the workers, then send them from here
+            key_chunks = _chunks(list(client_private_keys), chunk_count)
+            initiations = [result for chunk in executor.map(_build_initiations, repeat(server_public_key), key_chunks) for result in chunk]
+            for managed_session, (handshake_info, init_msg) in zip(sessions, initiations):
+                managed_session.manager.adopt_initiation(handshake_info)
+                self._register(handshake_info['client_index'], managed_session)
+                managed_session.manager.sock.send(init_msg)
+
+            pending = sessions
+            for attempt, delay in enumerate(encryption_manager.backoff_delays(timeout, attempts)):
+                if attempt:
+                    for managed_session in pending:
+                        managed_session._send_initiation()
+                deadline = time.monotonic() + delay
+                for managed_session in pending:
+                    managed_session._responded.wait(max(0, deadline - time.monotonic()))
+                pending = [s for s in pending if not s._responded.is_set()]
+                if not pending:
+                    break
+
+            # Process every response in the workers
+            responded = [s for s in sessions if s._responded.is_set()]
+            work = [(*s._handshake_response, s.manager.client_private_key) for s in responded]
+            results = [result for chunk in executor.map(_process_responses, _chunks(work, chunk_count)) for result in chunk]
+
+        failed = list(pending)
+        for managed_session, result in zip(responded, results):
+            if result is None:
+                failed.append(managed_session)
+                continue
+            managed_session.manager.install_handshake(*result)
+            managed_session._defer_handshake = False
+            managed_session._established.set()
+
+        if failed:
+            for managed_session in sessions:
+                self._unregister(managed_session)
+            raise TimeoutError(f"Handshake failed for {len(failed)} of {len(sessions)} sessions")
+
+        if connect:
+            self.connect_sessions(sessions, timeout, attempts)
+        return sessions
+
+    def open_session(self, server_address, server_public_key, client_private_key, **kwargs):
+        return self.open_sessions(server_address, server_public_key, [client_private_key], **kwargs)[0]
+
+    def sessions(self):
+        with self._lock:
+            return list({id(s): s for s in self._sessions_by_index.values()}.values())
+
+    # stats_snapshot() of every open session, tagged with its chat session id
+    def stats(self):
+        return [dict(managed_session.manager.stats_snapshot(), session=managed_session.session)
+                for managed_session in self.sessions()]
+
+    def close(self):
+        for managed_session in self.sessions():
+            try:
+                managed_session.close()
+            except Exception:
+                pass
+        self.running = False
+        self.sock.close()
@@ -0,0 +1,77 @@
+import pytest
+from cryptography.exceptions import InvalidTag
+import encryption
+
+BACKENDS = sorted(encryption.AEAD_BACKENDS)
+KEY = bytes(range(0x80, 0xa0))
+NONCE = bytes.fromhex('070000004041424344454647')
+AUTHTEXT = bytes.fromhex('50515253c0c1c2c3c4c5c6c7')
+# RFC 8439 section 2.8.2
+PLAINTEXT = (b"Ladies and Gentlemen of the class of '99: If I could offer you only one tip for the future, "
+             b"sunscreen would be it.")
+TAG = bytes.fromhex('1ae10b594f09e26a7e902ecbd0600691')
+
+# Sizes around the 64-byte ChaCha20 block and 16-byte Poly1305 block boundaries, up to a full datagram
+SIZES = (0, 1, 15, 16, 17, 63, 64, 65, 1400)
+# The buffer types packets arrive in: received datagrams, bytearray packets and views over them
+BUFFERS = (bytes, bytearray, memoryview)
+
+def _payload(size):
+    return bytes(i * 7 % 256 for i in range(size))
+
+@pytest.mark.parametrize('name', BACKENDS)
+def test_rfc8439_vector(name):
+    backend = encryption.AEAD_BACKENDS[name]()
+    sealed = backend.encrypt(KEY, NONCE, PLAINTEXT, AUTHTEXT)
+    assert len(sealed) == len(PLAINTEXT) + encryption.AEAD_TAG_SIZE
+    assert sealed[-16:] == TAG
+    assert backend.decrypt(KEY, NONCE, sealed, AUTHTEXT) == PLAINTEXT
+
+@pytest.mark.parametrize('size', SIZES)
+def test_backends_agree(size):
+    plaintext = _payload(size)
+    sealed = {name: encryption.AEAD_BACKENDS[name]().encrypt(KEY, NONCE, plaintext, AUTHTEXT) for name in BACKENDS}
+    assert len(set(sealed.values())) == 1
+
+    # every backend opens what any backend sealed
+    for name in BACKENDS:
+        backend = encryption.AEAD_BACKENDS[name]()
+        for ciphertext in sealed.values():
+            assert backend.decrypt(KEY, NONCE, ciphertext, AUTHTEXT) == plaintext
+
+@pytest.mark.parametrize('name', BACKENDS)
+@pytest.mark.parametrize('buffer', BUFFERS, ids=lambda buffer: buffer.__name__)
+def test_buffer_inputs(name, buffer):
+    backend = encryption.AEAD_BACKENDS[name]()
+    plaintext = _payload(100)
+    expected = encryption.AEAD_BACKENDS['reference']().encrypt(KEY, NONCE, plaintext, b'')
+
+    assert bytes(backend.encrypt(KEY, NONCE, buffer(plaintext), b'')) == expected
+    assert bytes(backend.decrypt(KEY, NONCE, buffer(expected), b'')) == plaintext
+
+    # keyed cipher objects, as used by TransportSession
+    cipher = backend.cipher(KEY)
+    assert bytes(cipher.encrypt(NONCE, buffer(plaintext), b'')) == expected
+    assert bytes(cipher.decrypt(NONCE, buffer(expected), b'')) == plaintext
+
+@pytest.mark.parametrize('name', BACKENDS)
+def test_decrypt_of_a_view_into_a_packet(name):
+    # received transport packets are decrypted through a memoryview past the 16-byte header
+    backend = encryption.AEAD_BACKENDS[name]()
+    plaintext = _payload(200)
+    packet = bytearray(16) + backend.encrypt(KEY, NONCE, plaintext, b'')
+    assert bytes(backend.decrypt(KEY, NONCE, memoryview(packet)[16:], b'')) == plaintext
+
+@pytest.mark.parametrize('name', BACKENDS)
+def test_tampering_is_rejected(name):
+    backend = encryption.AEAD_BACKENDS[name]()
+    sealed = backend.encrypt(KEY, NONCE, PLAINTEXT, AUTHTEXT)
+    for index in (0, len(PLAINTEXT) - 1, len(sealed) - 1):
+        tampered = bytearray(sealed)
+        tampered[index] ^= 1
+        with pytest.raises(InvalidTag):
+            backend.decrypt(KEY, NONCE, bytes(tampered), AUTHTEXT)
+    with pytest.raises(InvalidTag):
+        backend.decrypt(KEY, NONCE, sealed, AUTHTEXT[:-1])
+    with pytest.raises(InvalidTag):
+        backend.decrypt(KEY, bytes(12), sealed, AUTHTEXT)
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+import encryption
+import encryption_manager
+import session_manager
+from chatClientAsync import AsyncChatClient
+from chatClientFunctions import ChatClient
+from localChatServer import LocalChatServer
+
+class _ForgingSocket:
+    # Sends a corrupted copy of every handshake response (type 2) and a forged cookie reply (type 3, same index)
+    # just ahead of the real response
+    def __init__(self, sock):
+        self._sock = sock
+
+    def sendto(self, data, address):
+        if data[0] == 2:
+            corrupted = bytearray(data)
+            corrupted[50] ^= 0xFF  # inside the empty AEAD payload's tag
+            self._sock.sendto(bytes(corrupted), address)
+            self._sock.sendto(bytes([3, 0, 0, 0]) + data[8:12] + bytes(56), address)
+        return self._sock.sendto(data, address)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+@pytest.fixture
+def server():
+    server = LocalChatServer(('127.0.0.1', 0))
+    server.sock = _ForgingSocket(server.sock)
+    server.start()
+    yield server
+    server.close()
+
+def test_chat_client_survives_forged_handshake_replies(server):
+    client = ChatClient(server.address, server.public_key, encryption.DH_Generate()[0], keepalive_interval=3600)
+    try:
+        assert client.session is not None
+        assert client.manager.stats.handshakes == 1
+        assert client.manager.stats.handshake_failures == 2
+    finally:
+        client.close()
+
+def test_session_manager_survives_forged_handshake_replies(server):
+    manager = session_manager.SessionManager(('127.0.0.1', 0))
+    try:
+        sessions = manager.open_sessions(server.address, server.public_key, [encryption.DH_Generate()[0] for _ in range(5)])
+        assert all(s.session is not None for s in sessions)
+    finally:
+        manager.close()
+
+def test_async_client_survives_forged_handshake_replies(server):
+    async def run():
+        async with AsyncChatClient(server.address, server.public_key, encryption.DH_Generate()[0]) as client:
+            assert client.manager.stats.handshake_failures == 2
+            return (await client.request("/WHOAMI"))['username']
+    assert asyncio.run(run()).startswith("guest")
+
+def test_failed_reply_keeps_the_handshake_pending():
+    manager = encryption_manager.EncryptionManager(encryption.DH_Generate()[1], encryption.DH_Generate()[0], None, establish=False)
+    init_msg = manager.begin_handshake()
+    pending = manager._pending_handshake
+    with pytest.raises(encryption_manager.InvalidHandshakeReply):
+        manager.complete_handshake(bytes([2, 0, 0, 0]) + bytes(4) + pending['client_index'] + bytes(80))
+    assert manager._pending_handshake is pending
+    assert manager.stats.handshake_failures == 1
@@ -0,0 +1,59 @@
+import threading
+import pytest
+import encryption
+import session_manager
+from chatClientFunctions import ChatClient, CLIENT_PRIVATE_KEY
+from localChatServer import LocalChatServer
+
+@pytest.fixture
+def server():
+    server = LocalChatServer(('127.0.0.1', 0)).start()
+    yield server
+    server.close()
+
+def connect(server, private_key):
+    # ChatClient leaves receiving to its user (the GUI's listener thread), so the tests run one per client
+    client = ChatClient(server.address, server.public_key, private_key, keepalive_interval=3600)
+
+    def listen():
+        while True:
+            try:
+                client.receive()
+            except OSError:
+                break
+    threading.Thread(target=listen, daemon=True).start()
+    return client
+
+def test_clients_sharing_a_key_get_separate_sessions(server):
+    clients = [connect(server, CLIENT_PRIVATE_KEY) for _ in range(3)]
+    try:
+        assert len({client.session for client in clients}) == 3
+        usernames = [client.send_request("/WHOAMI").result(2)['username'] for client in clients]
+        assert usernames == [client.welcome_message['username'] for client in clients]
+        assert len(set(usernames)) == 3
+    finally:
+        for client in clients:
+            client.close()
+
+def test_shared_key_handshakes_before_connect(server):
+    # every handshake completes before the first CONNECT is sent
+    manager = session_manager.SessionManager(('127.0.0.1', 0))
+    try:
+        sessions = manager.open_sessions(server.address, server.public_key, [CLIENT_PRIVATE_KEY] * 10)
+        assert len({s.session for s in sessions}) == 10
+    finally:
+        manager.close()
+
+def test_rekey_keeps_the_chat_session(server):
+    client = connect(server, encryption.DH_Generate()[0])
+    try:
+        username = client.welcome_message['username']
+        client.manager._start_rekey()
+        for _ in range(20):
+            if client.manager.previous_session is not None:
+                break
+            client.send_request(3).result(2)
+        assert client.manager.previous_session is not None
+        assert client.send_request("/WHOAMI").result(2)['username'] == username
+    finally:
+        client.close()
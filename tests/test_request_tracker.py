@@ -0,0 +1,67 @@
+import time
+from concurrent.futures import Future
+import pytest
+from chatClientFunctions import RequestError, RequestTracker, request_packet
+
+def submit(tracker, request_type=10, timeout=5.0, **arguments):
+    future = Future()
+    packet = request_packet(1, request_type, **(arguments or {'username': 'alice'}))
+    tracker.add(future, packet, timeout)
+    return future, packet
+
+def wait_due(tracker):
+    time.sleep(max(0, tracker.next_due() - time.monotonic()))
+    return tracker.due()
+
+def test_response_resolves_the_matching_future():
+    tracker = RequestTracker()
+    future, packet = submit(tracker)
+    assert tracker.response({'response_type': 31, 'request_handle': packet['request_handle']}) is True
+    assert future.result(0)['response_type'] == 31
+    assert future.rtt is not None and tracker.rtt.samples == 1
+    assert len(tracker) == 0
+
+def test_error_response_and_unsolicited_messages():
+    tracker = RequestTracker()
+    future, packet = submit(tracker)
+    assert tracker.response({'response_type': 30, 'message': 'hi'}) is False
+    tracker.response({'response_type': 20, 'error': 'nope', 'request_handle': packet['request_handle']})
+    with pytest.raises(RequestError, match='nope'):
+        future.result(0)
+
+def test_timeout_fails_the_future():
+    tracker = RequestTracker()
+    future, _ = submit(tracker, timeout=0.01)
+    assert wait_due(tracker) == []
+    with pytest.raises(TimeoutError):
+        future.result(0)
+
+def test_retransmission_and_duplicate_responses():
+    tracker = RequestTracker(reliable=True)
+    tracker.rtt.rto = 0.01
+    future, packet = submit(tracker)
+    assert wait_due(tracker) == [packet]
+
+    response = {'response_type': 31, 'request_handle': packet['request_handle']}
+    assert tracker.response(response) is True
+    # the answer to the other transmission is a duplicate, and the ambiguous round trip is not sampled (Karn)
+    assert tracker.response(dict(response)) is None
+    assert tracker.rtt.samples == 0
+
+def test_non_idempotent_requests_are_not_retransmitted():
+    tracker = RequestTracker(reliable=True)
+    tracker.rtt.rto = 0.01
+    future, _ = submit(tracker, 9, timeout=0.05, channel='general', message='hi')
+    while not future.done():
+        assert wait_due(tracker) == []
+
+def test_dead_peer_after_unanswered_pings():
+    dead = []
+    tracker = RequestTracker(dead_peer_pings=2, on_dead_peer=lambda: dead.append(True))
+    for _ in range(2):
+        future, _ = submit(tracker, 3, timeout=0.01)
+        future.add_done_callback(tracker.ping_done)
+        wait_due(tracker)
+    assert dead == [True] and not tracker.peer_alive
+    tracker.response({'response_type': 30})
+    assert tracker.peer_alive
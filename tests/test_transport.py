@@ -0,0 +1,108 @@
+import nacl.bindings
+import pytest
+from cryptography.exceptions import InvalidTag
+import encryption
+
+CHAIN_KEY = bytes(range(32))
+CLIENT_INDEX = b'\x01\x02\x03\x04'
+SERVER_INDEX = b'\x05\x06\x07\x08'
+
+@pytest.fixture
+def sessions():
+    client = encryption.TransportSession.from_handshake(CHAIN_KEY, {'client_index': CLIENT_INDEX,
+                                                                    'server_index': SERVER_INDEX})
+    server = encryption.TransportSession.for_responder(CHAIN_KEY, SERVER_INDEX, CLIENT_INDEX)
+    return client, server
+
+# Replay window
+
+def test_replay_window_accepts_each_counter_once():
+    window = encryption.ReplayWindow(size=64)
+    for counter in (0, 2, 1, 5, 3):
+        assert window.check(counter)
+        window.update(counter)
+    for counter in (0, 1, 2, 3, 5):
+        assert not window.check(counter)
+    assert window.check(4)
+
+def test_replay_window_rejects_counters_behind_the_window():
+    window = encryption.ReplayWindow(size=64)
+    window.update(100)
+    assert window.check(37)
+    assert not window.check(36)
+    # a jump past the whole window forgets everything before it
+    window.update(1000)
+    assert not window.check(100)
+    assert window.check(999)
+    assert not window.check(encryption.REJECT_AFTER_MESSAGES)
+
+# Framing
+
+def test_transport_framing(sessions):
+    client, server = sessions
+    packet = client.encrypt(b'hello')
+    assert len(packet) == encryption.TRANSPORT_HEADER.size + 5 + encryption.AEAD_TAG_SIZE
+    msg_type, receiver_index, counter, encrypted = encryption.unpack_transport_header(packet)
+    assert (msg_type, receiver_index, counter) == (4, SERVER_INDEX, 0)
+    assert bytes(packet[1:4]) == b'\x00\x00\x00'
+    assert isinstance(encrypted, memoryview) and len(encrypted) == 5 + encryption.AEAD_TAG_SIZE
+
+    assert server.decrypt(packet) == b'hello'
+    assert encryption.unpack_transport_header(server.encrypt(b'hi'))[1] == CLIENT_INDEX
+
+def test_batch_counters_follow_single_packets(sessions):
+    client, server = sessions
+    packets = [client.encrypt(b'a')] + client.encrypt_many([b'b', b'c'])
+    assert [encryption.unpack_transport_header(p)[2] for p in packets] == [0, 1, 2]
+    assert server.decrypt_many(reversed(packets)) == [b'c', b'b', b'a']
+    assert server.receiving_counter == 2
+
+def test_replayed_packet_is_rejected(sessions):
+    client, server = sessions
+    packet = client.encrypt(b'once')
+    assert server.decrypt(packet) == b'once'
+    with pytest.raises(encryption.ReplayError):
+        server.decrypt(packet)
+    assert server.decrypt_many([packet]) == [None]
+
+def test_forged_packet_does_not_move_the_window(sessions):
+    client, server = sessions
+    packet = client.encrypt(b'payload')
+    forged = bytearray(packet)
+    forged[-1] ^= 1
+    with pytest.raises(InvalidTag):
+        server.decrypt(forged)
+    # the genuine packet with the same counter is still accepted
+    assert server.decrypt(packet) == b'payload'
+
+# Cookie reply
+
+def _cookie_reply(receiver_index, cookie, mac1, server_public_key, nonce=bytes(range(24))):
+    # What a responder under load sends back (message type 3)
+    cookie_key = encryption.MixHash(encryption.LABELCOOKIE, server_public_key)
+    encrypted_cookie = nacl.bindings.crypto_aead_xchacha20poly1305_ietf_encrypt(cookie, mac1, nonce, cookie_key)
+    return bytes([3, 0, 0, 0]) + receiver_index + nonce + encrypted_cookie
+
+def test_cookie_reply_round_trip():
+    _, server_public_key = encryption.DH_Generate()
+    client_private_key, _ = encryption.DH_Generate()
+    handshake_info, initiation, _ = encryption.get_Initiation_Message(server_public_key, client_private_key)
+    assert initiation[-16:] == bytes(16)
+    mac1 = handshake_info['mac1']
+    assert initiation[-32:-16] == mac1
+    cookie = b'c' * 16
+
+    reply = _cookie_reply(handshake_info['client_index'], cookie, mac1, server_public_key)
+    assert encryption.consume_Cookie_Reply(reply, server_public_key, mac1) == (handshake_info['client_index'], cookie)
+
+    # the next initiation carries MAC2 over everything before it
+    _, initiation, _ = encryption.get_Initiation_Message(server_public_key, client_private_key, cookie=cookie)
+    assert initiation[-16:] == encryption.get_MAC2(cookie, initiation[:-16])
+
+def test_cookie_reply_is_bound_to_the_initiation():
+    _, server_public_key = encryption.DH_Generate()
+    reply = _cookie_reply(CLIENT_INDEX, b'c' * 16, b'm' * 16, server_public_key)
+    with pytest.raises(nacl.exceptions.CryptoError):
+        encryption.consume_Cookie_Reply(reply, server_public_key, b'x' * 16)
+    with pytest.raises(ValueError):
+        encryption.consume_Cookie_Reply(reply[:-1], server_public_key, b'm' * 16)